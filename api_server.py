@@ -1,13 +1,20 @@
 import os
+import re
+import json
+import base64
 import psutil
 import subprocess
+from bson import ObjectId
+from bson.errors import InvalidId
 from flask_cors import CORS
-from flask import Flask, jsonify, send_file, request
+from flask import Flask, Response, jsonify, send_file, request
 from flask_pymongo import PyMongo
 from flask_jwt_extended import JWTManager, create_access_token, verify_jwt_in_request
 from flask_swagger_ui import get_swaggerui_blueprint
 from dotenv import load_dotenv
-from utils import log_info
+from utils import log_info, STORE_KEYS, GENERATION_COLLECTION
+from price_parser import to_minor
+from response_cache import ResponseCache, Generations, cache_key
 
 # Flask app initialization
 app = Flask(__name__)
@@ -28,6 +35,10 @@ password = os.getenv("password", "password123")
 mongo = PyMongo(app)
 jwt = JWTManager(app)
 
+# Game responses are cached until update_mongo bumps the generation of their collection
+response_cache = ResponseCache()
+generations = Generations(mongo.db[GENERATION_COLLECTION])
+
 # Custom token verification without Bearer prefix
 def custom_token_verification():
     auth_header = request.headers.get("Authorization")
@@ -133,6 +144,45 @@ swagger_config = {
                         "name": "region",
                         "in": "query",
                         "type": "string"
+                    },
+                    {
+                        "name": "after",
+                        "in": "query",
+                        "type": "string",
+                        "required": False,
+                        "description": "next_cursor of the previous response, replaces page"
+                    },
+                    {
+                        "name": "fields",
+                        "in": "query",
+                        "type": "string",
+                        "required": False,
+                        "description": "Comma separated fields to return, e.g. title,header_image"
+                    },
+                    {
+                        "name": "min_price",
+                        "in": "query",
+                        "type": "number",
+                        "required": False,
+                        "description": "Lowest price in the currency of region, needs region"
+                    },
+                    {
+                        "name": "max_price",
+                        "in": "query",
+                        "type": "number",
+                        "required": False,
+                        "description": "Highest price in the currency of region, needs region"
+                    },
+                    {
+                        "name": "sort",
+                        "in": "query",
+                        "type": "string",
+                        "enum": [
+                            "price",
+                            "-price"
+                        ],
+                        "required": False,
+                        "description": "Priced games only, cheapest or most expensive first, needs region"
                     }
                 ],
                 "security": [
@@ -151,10 +201,16 @@ swagger_config = {
                                     "items": {
                                         "type": "object"
                                     }
+                                },
+                                "next_cursor": {
+                                    "type": "string"
                                 }
                             }
                         }
                     },
+                    "400": {
+                        "description": "Invalid cursor, fields, region, price or sort."
+                    },
                     "401": {
                         "description": "Unauthorized."
                     }
@@ -221,6 +277,66 @@ swagger_config = {
                 }
             }
         },
+        "/games/cheapest": {
+            "get": {
+                "summary": "Cheapest Region",
+                "description": "Every region price of a game converted to one currency, with the cheapest region and the spread. Without key or title, the cheapest games of the service.",
+                "parameters": [
+                    {
+                        "name": "service",
+                        "in": "query",
+                        "type": "string",
+                        "enum": [
+                            "steam",
+                            "xbox",
+                            "playstation",
+                            "nintendo"
+                        ],
+                        "required": True
+                    },
+                    {
+                        "name": "key",
+                        "in": "query",
+                        "type": "string",
+                        "required": False,
+                        "description": "Store key of the game: appid, concept_id, product_id or slug"
+                    },
+                    {
+                        "name": "title",
+                        "in": "query",
+                        "type": "string",
+                        "required": False
+                    },
+                    {
+                        "name": "page",
+                        "in": "query",
+                        "type": "integer",
+                        "required": False,
+                        "default": 1
+                    },
+                    {
+                        "name": "per_page",
+                        "in": "query",
+                        "type": "integer",
+                        "required": False,
+                        "default": 10
+                    }
+                ],
+                "security": [
+                    {
+                        "TokenAuth": []
+                    }
+                ],
+                "responses": {
+                    "200": {
+                        "description": "Cheapest prices retrieved successfully."
+                    },
+                    "400": {
+                        "description": "Invalid service."
+                    }
+                }
+            }
+        },
         "/games/count": {
             "get": {
                 "summary": "Get Game Count",
@@ -374,11 +490,76 @@ def stop_scheduler():
     except Exception as e:
         return jsonify({"msg": f"Error stopping scheduler: {str(e)}"}), 500
 
+# Store collection of the service parameter, None for an unknown service
+def service_collection(service):
+    collection_name = f"{service}_games"
+    return collection_name if collection_name in STORE_KEYS else None
+
+# Serves the response of the current generation of collection_name from the cache, or
+# computes and caches it. Only 200 responses are cached. Clients revalidate with the ETag
+# and get a 304 until the collection changes.
+def cached_response(collection_name, compute):
+    if collection_name is None:
+        return compute()
+    key = cache_key(request.path, collection_name, generations.get(collection_name), request.args)
+    entry = response_cache.get(key)
+    cache_status = "HIT"
+    if entry is None:
+        response, status = compute()
+        if status != 200:
+            return response, status
+        entry = response_cache.set(key, response.get_data())
+        cache_status = "MISS"
+
+    tag, body = entry
+    if request.if_none_match.contains(tag.strip('"')):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype="application/json")
+    response.headers["ETag"] = tag
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Cache"] = cache_status
+    return response
+
+# Reads the view update_mongo builds after each run, one indexed lookup per game
+@app.route('/games/cheapest', methods=['GET'])
+def get_cheapest():
+    auth_result = custom_token_verification()
+    if isinstance(auth_result, tuple):
+        return auth_result
+    return cached_response(service_collection(request.args.get('service')), cheapest_response)
+
+def cheapest_response():
+    service = request.args.get('service')
+    key = request.args.get('key')
+    title = request.args.get('title')
+    page, per_page, error = page_args()
+    if error:
+        return error
+
+    collection_name = service_collection(service)
+    if collection_name is None:
+        return jsonify({"msg": "Invalid service"}), 400
+    collection = mongo.db[f"{collection_name}_cheapest"]
+    key_field = STORE_KEYS[collection_name]
+
+    if key:
+        query = {key_field: int(key) if key.isdigit() and service == "steam" else key}
+    elif title:
+        query = {"title": title}
+    else:
+        query = {}
+    games = list(collection.find(query, {"_id": 0}).sort("min_price", 1).skip((page - 1) * per_page).limit(per_page))
+    return jsonify({"games": games}), 200
+
 @app.route('/games/count', methods=['GET'])
 def get_game_count():
     auth_result = custom_token_verification()
     if isinstance(auth_result, tuple):
         return auth_result
+    return cached_response(service_collection(request.args.get('service')), count_response)
+
+def count_response():
     service = request.args.get('service')
 
     if service == "steam":
@@ -392,7 +573,8 @@ def get_game_count():
     else:
         return jsonify({"msg": "Invalid service"}), 400
     
-    count = collection.count_documents({})
+    # From the collection metadata, no scan. Stale games are counted on their partial index.
+    count = collection.estimated_document_count() - collection.count_documents({"stale": True})
     return jsonify({"count": count}), 200
 
 @app.route('/logs', methods=['GET'])
@@ -421,14 +603,50 @@ def get_games():
     auth_result = custom_token_verification()
     if isinstance(auth_result, tuple):
         return auth_result
-    page = int(request.args.get('page', 1))
-    per_page = int(request.args.get('per_page', 10))
+    return cached_response(service_collection(request.args.get('service')) or "steam_games", games_response)
+
+def games_response():
+    page, per_page, error = page_args()
+    if error:
+        return error
     service = request.args.get('service')
     region = request.args.get('region')
-    
-    filters = {}
+    fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+    after = request.args.get('after')
+    sort = request.args.get('sort')
+    min_price = request.args.get('min_price')
+    max_price = request.args.get('max_price')
+
+    if region and not REGION_PATTERN.match(region):
+        return jsonify({"msg": "Invalid region"}), 400
+    if any(not FIELD_PATTERN.match(field) for field in fields):
+        return jsonify({"msg": "Invalid fields"}), 400
+    if sort not in (None, "price", "-price"):
+        return jsonify({"msg": "Invalid sort"}), 400
+    if (sort or min_price or max_price) and not region:
+        return jsonify({"msg": "Price filters and sort=price need a region"}), 400
+    if after:
+        try:
+            after = decode_cursor(after)
+        except (ValueError, TypeError, IndexError, InvalidId):
+            return jsonify({"msg": "Invalid cursor"}), 400
+        if sort and after[1] is None:
+            return jsonify({"msg": "Cursor of another sort order"}), 400
+
+    filters = {"stale": {"$ne": True}}  # Gone from the store since an incremental run
     if region:
         filters["prices." + region] = {"$ne": "Free or Not Available"}
+    # Range on the amount parsed at ingest, in the minor units of the region's currency
+    price_range = {}
+    try:
+        if min_price:
+            price_range["$gte"] = to_minor(min_price, region)
+        if max_price:
+            price_range["$lte"] = to_minor(max_price, region)
+    except (ValueError, OverflowError):  # "abc", "inf"
+        return jsonify({"msg": "Invalid price"}), 400
+    if price_range:
+        filters[f"price_values.{region}.amount_minor"] = price_range
 
     if service == "steam":
         collection = mongo.db.steam_games
@@ -441,21 +659,88 @@ def get_games():
     else:
         collection = mongo.db.steam_games
 
-    games = paginate(collection, page, per_page, filters)
+    games, next_cursor = paginate(collection, page, per_page, filters, after, fields, region, sort)
+    return jsonify({"games": games, "next_cursor": next_cursor}), 200
 
-    for game in games:
-        if region in game['prices']:
-            game['price'] = game['prices'].get(region, "Not Available")
-            del game['prices']
-    return jsonify({"games": games}), 200
+# page and per_page of a request as (page, per_page, None), or (None, None, 400 response)
+def page_args():
+    try:
+        page = int(request.args.get('page', 1))
+        per_page = int(request.args.get('per_page', 10))
+    except ValueError:
+        return None, None, (jsonify({"msg": "Invalid page"}), 400)
+    if page < 1 or per_page < 1:
+        return None, None, (jsonify({"msg": "page and per_page must be at least 1"}), 400)
+    return page, per_page, None
+
+REGION_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+FIELD_PATTERN = re.compile(r'^[A-Za-z0-9_]+(\.[A-Za-z0-9_-]+)*$')
+
+# The cursor is the _id of the last game of a page, with its price when sorted by price.
+# Opaque to clients. Returns (_id, price or None).
+def encode_cursor(object_id, price=None):
+    value = [str(object_id)] if price is None else [str(object_id), price]
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    value = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    return ObjectId(value[0]), (int(value[1]) if len(value) > 1 else None)
+
+# Helper function to paginate results, in _id order, or by the region's amount then _id with
+# sort=price. With a cursor the page starts right after it on the index, page numbers still
+# work but skip over every earlier game.
+# fields and the region price are projected by MongoDB, so unused fields are never sent.
+# Returns (games, cursor of the next page or None on the last page).
+def paginate(collection, page, per_page, filters=None, after=None, fields=None, region=None, sort=None):
+    query = dict(filters or {})
+    direction = -1 if sort == "-price" else 1
+    after_op = "$lt" if direction == -1 else "$gt"
+    if sort:
+        amount_field = f"price_values.{region}.amount_minor"
+        query[amount_field] = {**query.get(amount_field, {}), "$type": "number"}  # Priced and free games only
+        order = {amount_field: direction, "_id": direction}
+        if after:
+            object_id, amount = after
+            query = {"$and": [query, {"$or": [
+                {amount_field: {after_op: amount}},
+                {amount_field: amount, "_id": {after_op: object_id}},
+            ]}]}
+    else:
+        order = {"_id": 1}
+        if after:
+            query["_id"] = {"$gt": after[0]}
+    pipeline = [{"$match": query}, {"$sort": order}]
+    if not after and page > 1:
+        pipeline.append({"$skip": (page - 1) * per_page})
+    pipeline.append({"$limit": per_page})
+    if sort:
+        pipeline.append({"$addFields": {"_cursor_price": f"${amount_field}"}})
+
+    price = {"$ifNull": [f"$prices.{region}", "Not Available"]}
+    if fields:
+        projection = {field: 1 for field in fields}
+        if region:
+            projection["price"] = price
+        if sort:
+            projection["_cursor_price"] = 1
+        pipeline.append({"$project": projection})
+    elif region:
+        # Only the region's parsed price, not the price_values of every region
+        pipeline += [
+            {"$addFields": {"price": price, "price_value": f"$price_values.{region}"}},
+            {"$project": {"prices": 0, "price_values": 0}},
+        ]
+    else:
+        pipeline.append({"$project": {"price_values": 0}})  # Parsed copy of prices, only sent when asked for in fields
 
-# Helper function to paginate results
-def paginate(collection, page, per_page, filters=None):
-    query = {}
-    if filters:
-        query = filters
-    results = list(collection.find(query, {"_id": 0}).skip((page - 1) * per_page).limit(per_page))
-    return results
+    results = list(collection.aggregate(pipeline))
+    next_cursor = None
+    if len(results) == per_page:
+        next_cursor = encode_cursor(results[-1]["_id"], results[-1].get("_cursor_price") if sort else None)
+    for game in results:
+        game.pop("_id", None)
+        game.pop("_cursor_price", None)
+    return results, next_cursor
 
 if __name__ == '__main__':
     app.run(host=access_ip, port=server_port, debug=False)
\ No newline at end of file
@@ -0,0 +1,43 @@
+import sys
+import glob
+import time
+from parsers import (
+    BACKENDS, SelectorSet, PLAYSTATION_GAME_FIELDS, PLAYSTATION_PRICE_FIELDS, PLAYSTATION_PRICE_MARKER
+)
+
+# Parse throughput of every installed backend on saved store pages.
+# Usage: python bench_parsers.py [fixtures_dir] [rounds]
+# fixtures_dir holds saved PlayStation concept and price pages as *.html, the default
+# tests/fixtures has a few trimmed pages so the benchmark runs out of the box. Full pages
+# give more realistic numbers, the store pages are 300-500 KB.
+
+def bench(pages, rounds, extract):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for page in pages:
+            extract(page)
+    elapsed = time.perf_counter() - start
+    return len(pages) * rounds / elapsed
+
+def main():
+    fixtures_dir = sys.argv[1] if len(sys.argv) > 1 else "tests/fixtures"
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    paths = sorted(glob.glob(f"{fixtures_dir}/*.html"))
+    if not paths:
+        print(f"No *.html fixtures found in {fixtures_dir}")
+        return
+    pages = []
+    for path in paths:
+        with open(path, "rb") as f:
+            pages.append(f.read())
+    print(f"{len(pages)} pages, {sum(len(page) for page in pages) // 1024} KB, {rounds} rounds")
+
+    for name in BACKENDS:
+        game_selectors = SelectorSet(PLAYSTATION_GAME_FIELDS, backend=name)
+        price_selectors = SelectorSet(PLAYSTATION_PRICE_FIELDS, backend=name)
+        full = bench(pages, rounds, game_selectors.extract)
+        price = bench(pages, rounds, lambda page: price_selectors.extract_fragment(page, "price", PLAYSTATION_PRICE_MARKER))
+        print(f"{name:>10} : {full:8.1f} pages/s full extract, {price:8.1f} pages/s price only")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import zlib
+import atexit
+import sqlite3
+import threading
+from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+http_cache = os.getenv("http_cache", "1") == "1"  # Conditional requests against the on-disk cache
+http_cache_path = os.getenv("http_cache_path", "http_cache.sqlite")
+http_cache_mb = float(os.getenv("http_cache_mb", 2048))  # Compressed bodies kept before LRU eviction
+stats_flush_every = 100  # Events counted in memory before they are added to the shared stats
+
+# Headers that describe the transfer, not the body, they are not replayed from the cache
+SKIPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "set-cookie"}
+STAT_NAMES = ("hits", "misses", "stores", "evictions", "bytes_saved")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    status INTEGER,
+    headers TEXT,
+    body BLOB,
+    size INTEGER,
+    last_used REAL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER);
+"""
+
+def cache_key(url, params=None):
+    if not params:
+        return url
+    return f"{url}{'&' if '?' in url else '?'}{urlencode(sorted(params.items()))}"
+
+# Validators and compressed bodies of GET responses in SQLite. Any number of processes can
+# use the same file, each opens its own connection.
+class HttpCache:
+    def __init__(self, path=http_cache_path, max_mb=http_cache_mb):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.pending = dict.fromkeys(STAT_NAMES, 0)
+        self.events = 0
+        self.stores_since_evict = 0
+        atexit.register(self.flush_stats)
+
+    # Returns the cached entry of the url, or None
+    def lookup(self, url):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT etag, last_modified, status, headers, body FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, status, headers, body = row
+        return {"etag": etag, "last_modified": last_modified, "status": status,
+                "headers": json.loads(headers), "body": body}
+
+    @staticmethod
+    def validators(entry):
+        headers = {}
+        if entry and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    # Body of an entry after a 304, counts the hit. The body is already in memory, so a
+    # locked database only costs the LRU and stats update.
+    def hit(self, url, entry):
+        body = zlib.decompress(entry["body"])
+        try:
+            with self.lock:
+                self.connection.execute("UPDATE responses SET last_used = ? WHERE url = ?", (time.time(), url))
+            self.count("hits")
+            self.count("bytes_saved", len(body))
+        except sqlite3.Error:
+            pass
+        return body
+
+    # Keeps a 200 response that has a validator, others are only counted as misses
+    def store(self, url, status, headers, body):
+        self.count("misses")
+        headers = {k: v for k, v in headers.items() if k.lower() not in SKIPPED_HEADERS}
+        lower = {k.lower(): v for k, v in headers.items()}
+        etag, last_modified = lower.get("etag"), lower.get("last-modified")
+        if status != 200 or not (etag or last_modified) or "no-store" in lower.get("cache-control", ""):
+            return
+        blob = zlib.compress(body, 6)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, status, json.dumps(headers), blob, len(blob), time.time())
+            )
+        self.count("stores")
+        self.stores_since_evict += 1
+        if self.stores_since_evict >= stats_flush_every:  # The size check is a full sum, not done on every store
+            self.stores_since_evict = 0
+            self.evict()
+
+    # Drops the least recently used entries until the cache is back under 90% of its cap
+    def evict(self):
+        with self.lock:
+            total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            target = total - int(self.max_bytes * 0.9)
+            freed = 0
+            rows = self.connection.execute("SELECT url, size FROM responses ORDER BY last_used").fetchall()
+            urls = []
+            for url, size in rows:
+                if freed >= target:
+                    break
+                urls.append((url,))
+                freed += size
+            self.connection.executemany("DELETE FROM responses WHERE url = ?", urls)
+        self.count("evictions", len(urls))
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.pending[name] += value
+            self.events += 1
+            due = self.events >= stats_flush_every
+        if due:
+            self.flush_stats()
+
+    def flush_stats(self):
+        with self.lock:
+            pending, self.pending = self.pending, dict.fromkeys(STAT_NAMES, 0)
+            self.events = 0
+            self.connection.executemany(
+                "INSERT INTO stats VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                [(name, value) for name, value in pending.items() if value]
+            )
+
+    # Counters of all processes since the cache file was created
+    def stats(self):
+        self.flush_stats()
+        with self.lock:
+            rows = dict(self.connection.execute("SELECT name, value FROM stats").fetchall())
+            entries, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        stats = {name: rows.get(name, 0) for name in STAT_NAMES}
+        stats.update(entries=entries, size_mb=round(size / 1024 / 1024, 1))
+        return stats
+
+_cache = None
+_cache_pid = None
+
+# Cache of the current process, a forked worker opens its own connection
+def get_http_cache():
+    global _cache, _cache_pid
+    if not http_cache:
+        return None
+    if _cache is None or _cache_pid != os.getpid():
+        _cache = HttpCache()
+        _cache_pid = os.getpid()
+    return _cache
+
+# Sends cached validators with every GET and turns a 304 into the cached 200 response,
+# so an unchanged page costs one round trip and no body. Many processes share the file,
+# a locked or broken database only means the request is sent without the cache.
+class CachingAdapter(HTTPAdapter):
+    def send(self, request, **kwargs):
+        cache = get_http_cache()
+        if cache is None or request.method != "GET":
+            return super().send(request, **kwargs)
+
+        try:
+            entry = cache.lookup(request.url)
+        except sqlite3.Error:
+            return super().send(request, **kwargs)
+        request.headers.update(cache.validators(entry))
+        response = super().send(request, **kwargs)
+        response.from_cache = False
+        if response.status_code == 304 and entry:
+            response.status_code = entry["status"]
+            response.reason = "OK"
+            response.headers.update({k: v for k, v in entry["headers"].items() if k not in response.headers})
+            response._content = cache.hit(request.url, entry)
+            response.from_cache = True
+        elif not kwargs.get("stream"):
+            try:
+                cache.store(request.url, response.status_code, response.headers, response.content)
+            except sqlite3.Error:
+                pass
+        return response
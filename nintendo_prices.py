@@ -0,0 +1,121 @@
+import os
+import re
+import json
+import time
+import requests
+from utils import get_pooled_session, rate_limited_request, log_info, regions_nintendo
+
+# Bulk regional prices for the Nintendo scraper: each region's catalogue is listed once per
+# run and priced by nsuid in batches, the workers then look games up by normalized title
+EU_SEARCH_URL = "https://searching.nintendo-europe.com/en/select"  # Solr index behind the EU store search
+JP_SEARCH_URL = "https://search.nintendo.jp/nintendo_soft/search.json"
+PRICE_API_URL = "https://api.ec.nintendo.com/v1/price"
+price_index_path = os.getenv("nintendo_price_index", "nintendo_price_index.json")
+eu_page_size = 1000
+jp_page_size = 300
+price_batch_size = 50  # Most nsuids the price API takes at once
+HEADERS = {"User-Agent": "Mozilla/5.0"}
+
+# Same normalization as the US store slugs
+def normalize_title(title):
+    title = title.replace("&", "and").lower()
+    title = re.sub(r'[^a-z0-9 ]', '', title)
+    return title.replace(" ", "-")
+
+# Price key of a regions_nintendo search URL, "en-gb" gives "gb"
+def region_code(region_url):
+    return region_url.split('/')[3].split('-')[1]
+
+def fetch_json(session, url, params):
+    response = rate_limited_request(session, "GET", url, params=params, timeout=30)
+    response.raise_for_status()
+    return response.json()
+
+# {normalized title: nsuid} of the Switch games in the EU catalogue, shared by all EU countries
+def fetch_eu_titles(session):
+    titles = {}
+    start = 0
+    while True:
+        params = {
+            "q": "*", "fq": "type:GAME AND system_type:nintendoswitch*", "fl": "title,nsuid_txt",
+            "sort": "sorting_title asc", "start": start, "rows": eu_page_size, "wt": "json",
+        }
+        response = fetch_json(session, EU_SEARCH_URL, params)["response"]
+        for doc in response["docs"]:
+            nsuid = next((nsuid for nsuid in doc.get("nsuid_txt", []) if nsuid.startswith("7001")), None)
+            key = normalize_title(doc.get("title", ""))
+            if nsuid and key:
+                titles.setdefault(key, nsuid)
+        start += eu_page_size
+        if start >= response["numFound"]:
+            return titles
+
+# {normalized title: nsuid} of the Japanese Switch catalogue. Titles are mostly in Japanese,
+# only the ones with latin names get a key, as with the title search before.
+def fetch_jp_titles(session):
+    titles = {}
+    page = 1
+    while True:
+        params = {"opt_hard": "1_HAC", "limit": jp_page_size, "page": page, "sort": "sodate desc"}
+        result = fetch_json(session, JP_SEARCH_URL, params)["result"]
+        for item in result["items"]:
+            key = normalize_title(item.get("title", ""))
+            if item.get("nsuid") and key:
+                titles.setdefault(key, str(item["nsuid"]))
+        if page * jp_page_size >= result["total"] or not result["items"]:
+            return titles
+        page += 1
+
+# {nsuid: formatted price} in one country, the discounted price while a sale runs
+def fetch_country_prices(session, country, nsuids):
+    prices = {}
+    for i in range(0, len(nsuids), price_batch_size):
+        params = {"country": country, "lang": "en", "ids": ",".join(nsuids[i:i + price_batch_size])}
+        for entry in fetch_json(session, PRICE_API_URL, params).get("prices", []):
+            price = entry.get("discount_price") or entry.get("regular_price")
+            if entry.get("sales_status") == "onsale" and price:
+                prices[str(entry["title_id"])] = price["amount"]
+    return prices
+
+# {region: {normalized title: price}}. A region whose crawl fails is left out, the scraper
+# falls back to the store search there.
+def build_price_index():
+    session = get_pooled_session(headers=HEADERS)
+    catalogues = {}
+    for name, fetch_titles in (("eu", fetch_eu_titles), ("jp", fetch_jp_titles)):
+        try:
+            catalogues[name] = fetch_titles(session)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print(f"Nintendo : Error listing the {name} catalogue: {e}")
+
+    index = {}
+    regions = [(region_code(url), "eu") for url in regions_nintendo] + [("jp", "jp")]
+    for code, catalogue in regions:
+        titles = catalogues.get(catalogue)
+        if not titles:
+            continue
+        try:
+            prices = fetch_country_prices(session, code.upper(), list(set(titles.values())))
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print(f"Nintendo : Error fetching {code} prices: {e}")
+            continue
+        index[code] = {key: prices[nsuid] for key, nsuid in titles.items() if nsuid in prices}
+    log_info(f"Nintendo price index : {', '.join(f'{code} {len(prices)}' for code, prices in index.items()) or 'empty'}")
+    return index
+
+def save_price_index(index, path=price_index_path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"built_at": time.time(), "regions": index}, f, ensure_ascii=False)
+
+_index = None
+
+# Index written by the main process, loaded once per worker
+def load_price_index(path=price_index_path):
+    global _index
+    if _index is None:
+        try:
+            with open(path, encoding="utf-8") as f:
+                _index = json.load(f)["regions"]
+        except (OSError, ValueError, KeyError):
+            _index = {}
+    return _index
@@ -0,0 +1,230 @@
+import os
+import json
+import soupsieve
+from bs4 import BeautifulSoup
+
+# Optional C-backed parsers, the fastest installed one is used
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser  # The Modest parser is gone since selectolax 1.0
+except ImportError:
+    HTMLParser = None
+try:
+    import lxml.html
+    from lxml.cssselect import CSSSelector
+except ImportError:
+    CSSSelector = None
+
+html_parser = os.getenv("html_parser")  # Force a backend: "selectolax", "lxml" or "bs4"
+fragment_size = 4096  # Bytes parsed around a marker in fragment mode
+
+class SelectolaxBackend:
+    name = "selectolax"
+
+    def parse(self, html):
+        return HTMLParser(html)
+
+    def compile(self, selector):
+        return selector  # selectolax takes the CSS string as it is
+
+    def select_first(self, doc, selector):
+        return doc.css_first(selector)
+
+    def select_all(self, doc, selector):
+        return doc.css(selector)
+
+    def text(self, node):
+        return node.text().strip()
+
+    def attr(self, node, name):
+        return node.attributes.get(name)
+
+class LxmlBackend:
+    name = "lxml"
+
+    def parse(self, html):
+        return lxml.html.fromstring(html)
+
+    def compile(self, selector):
+        return CSSSelector(selector)  # Translated to XPath once
+
+    def select_first(self, doc, selector):
+        nodes = selector(doc)
+        return nodes[0] if nodes else None
+
+    def select_all(self, doc, selector):
+        return selector(doc)
+
+    def text(self, node):
+        return node.text_content().strip()
+
+    def attr(self, node, name):
+        return node.get(name)
+
+class SoupBackend:
+    name = "bs4"
+
+    def parse(self, html):
+        return BeautifulSoup(html, "html.parser")
+
+    def compile(self, selector):
+        return soupsieve.compile(selector)
+
+    def select_first(self, doc, selector):
+        return selector.select_one(doc)
+
+    def select_all(self, doc, selector):
+        return selector.select(doc)
+
+    def text(self, node):
+        return node.text.strip()
+
+    def attr(self, node, name):
+        return node.get(name)
+
+BACKENDS = {"bs4": SoupBackend}
+if CSSSelector is not None:
+    BACKENDS["lxml"] = LxmlBackend
+if HTMLParser is not None:
+    BACKENDS["selectolax"] = SelectolaxBackend
+
+def get_backend(name=None):
+    name = name or html_parser
+    if name:
+        return BACKENDS[name]()
+    for name in ("selectolax", "lxml", "bs4"):
+        if name in BACKENDS:
+            return BACKENDS[name]()
+
+# One value of a page: the text of the first match, an attribute of it, or the texts of all matches
+class Field:
+    def __init__(self, selector, attr=None, many=False, default=None):
+        self.selector = selector
+        self.attr = attr
+        self.many = many
+        self.default = [] if many and default is None else default
+
+# Fields of the store pages. The markers are raw strings next to the price node, for extract_fragment
+PLAYSTATION_GAME_FIELDS = {
+    "title": Field('[data-qa="mfe-game-title#name"]', default="N/A"),
+    "short_description": Field('[class="psw-l-switcher psw-with-dividers"]', default="N/A"),
+    "full_description": Field('[data-qa="pdp#overview"]', default="N/A"),
+    "header_image": Field('img[data-qa="gameBackgroundImage#heroImage#preview"]', attr="src", default="N/A"),
+    "rating": Field('[data-qa="mfe-star-rating#overall-rating#average-rating"]', default="N/A"),
+    "publisher": Field('[data-qa="gameInfo#releaseInformation#publisher-value"]', default="N/A"),
+    "platforms": Field('[data-qa="gameInfo#releaseInformation#platform-value"]', default="N/A"),
+    "release_date": Field('[data-qa="gameInfo#releaseInformation#releaseDate-value"]', default="N/A"),
+    "categories": Field('[data-qa="gameInfo#releaseInformation#genre-value"] span', many=True),
+}
+PLAYSTATION_PRICE_FIELDS = {
+    "price": Field('[data-qa="mfeCtaMain#offer0#finalPrice"]', default="Not Available"),
+}
+PLAYSTATION_PRICE_MARKER = 'data-qa="mfeCtaMain#offer0#finalPrice"'
+
+XBOX_PRICE_FIELDS = {
+    "price": Field('span.Price-module__boldText___1i2Li', default="N/A"),
+}
+XBOX_PRICE_MARKER = "Price-module__boldText___1i2Li"
+
+NEXT_DATA_MARKER = b'id="__NEXT_DATA__"'
+
+# The Apollo cache a Next.js store page embeds, found with a plain byte scan and decoded
+# on its own, without building an HTML tree
+def find_apollo_state(html):
+    data = html if isinstance(html, bytes) else html.encode("utf-8")
+    position = data.find(NEXT_DATA_MARKER)
+    if position == -1:
+        return None
+    start = data.find(b">", position) + 1
+    end = data.find(b"</script>", start)
+    if start == 0 or end == -1:
+        return None
+    try:
+        props = json.loads(data[start:end]).get("props", {})
+    except ValueError:
+        return None
+    return props.get("apolloState") or props.get("pageProps", {}).get("apolloState")
+
+def _resolve(state, value):
+    if isinstance(value, dict) and "__ref" in value:
+        return state.get(value["__ref"], {})
+    return value if isinstance(value, dict) else {}
+
+def _first_of_type(state, typename):
+    return next((value for key, value in state.items() if key.startswith(f"{typename}:")), {})
+
+# Concept page fields from the embedded JSON, in the schema of PLAYSTATION_GAME_FIELDS.
+# Returns None when the blob or the concept is missing, so the caller can use the DOM.
+def extract_playstation_json(html):
+    state = find_apollo_state(html)
+    if not state:
+        return None
+    concept = _first_of_type(state, "Concept")
+    if not concept.get("name"):
+        return None
+    product = _resolve(state, concept.get("defaultProduct")) or _first_of_type(state, "Product")
+
+    def first(key):
+        return concept.get(key) or product.get(key)
+
+    descriptions = {
+        item.get("type"): item.get("value")
+        for item in (product.get("descriptions") or []) + (concept.get("descriptions") or []) if isinstance(item, dict)
+    }
+    media = [_resolve(state, item) for item in first("media") or []]
+    header_image = next((item.get("url") for item in media if item.get("role") in ("BACKGROUND", "GAMEHUB_COVER_ART")), None)
+    rating = _resolve(state, first("starRating")).get("averageRating")
+    release_date = first("releaseDate")
+    genres = first("localizedGenres") or first("genres") or []
+
+    return {
+        "title": concept["name"],
+        "short_description": descriptions.get("SHORT") or "N/A",
+        "full_description": descriptions.get("LONG") or "N/A",
+        "header_image": header_image or "N/A",
+        "rating": str(rating) if rating is not None else "N/A",
+        "publisher": first("publisherName") or "N/A",
+        "platforms": ", ".join(product.get("platforms") or []) or "N/A",
+        "release_date": (release_date.get("value") if isinstance(release_date, dict) else release_date) or "N/A",
+        "categories": [genre.get("value") if isinstance(genre, dict) else genre for genre in genres],
+    }
+
+# The selectors of one store page, compiled once for the chosen backend
+class SelectorSet:
+    def __init__(self, fields, backend=None):
+        self.backend = get_backend(backend)
+        self.fields = fields
+        self.compiled = {name: self.backend.compile(field.selector) for name, field in fields.items()}
+
+    def extract(self, html, names=None):
+        doc = self.backend.parse(html)
+        return {name: self._value(doc, name) for name in (names or self.fields)}
+
+    # Fast path for pages where one value is needed: parse only the few KB around each
+    # occurrence of marker and stop at the first match. A page without the marker has no
+    # such node; if no fragment gives a value, the full page is parsed.
+    def extract_fragment(self, html, name, marker):
+        data = html if isinstance(html, bytes) else html.encode("utf-8")
+        marker = marker.encode("utf-8")
+        position = data.find(marker)
+        if position == -1:
+            return self.fields[name].default
+        while position != -1:
+            start = data.rfind(b"<", 0, position)
+            fragment = data[max(start, 0):position + fragment_size].decode("utf-8", "replace")
+            value = self._value(self.backend.parse(fragment), name)
+            if value != self.fields[name].default:
+                return value
+            position = data.find(marker, position + len(marker))
+        return self.extract(html, [name])[name]
+
+    def _value(self, doc, name):
+        field = self.fields[name]
+        selector = self.compiled[name]
+        if field.many:
+            values = [self.backend.text(node) for node in self.backend.select_all(doc, selector)]
+            return values or field.default
+        node = self.backend.select_first(doc, selector)
+        if node is None:
+            return field.default
+        value = self.backend.attr(node, field.attr) if field.attr else self.backend.text(node)
+        return field.default if value is None else value
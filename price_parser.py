@@ -0,0 +1,122 @@
+import re
+import json
+
+# Display prices of all stores parsed into {amount_minor, currency, status}. amount_minor is
+# the amount in the smallest unit of the currency (cents), so it can be compared and sorted.
+PRICED = "priced"
+FREE = "free"
+UNAVAILABLE = "unavailable"
+UNKNOWN = "unknown"
+
+# Currency of the price keys the scrapers use, for prices that only show "$", "kr" or no symbol
+REGION_CURRENCIES = {
+    "us": "USD", "ca": "CAD", "au": "AUD", "nz": "NZD", "mx": "MXN", "br": "BRL", "ar": "ARS", "co": "COP",
+    "gb": "GBP", "eu": "EUR", "at": "EUR", "be": "EUR", "de": "EUR", "es": "EUR", "fi": "EUR", "fr": "EUR",
+    "gr": "EUR", "it": "EUR", "lu": "EUR", "nl": "EUR", "pt": "EUR", "si": "EUR", "sk": "EUR",
+    "ch": "CHF", "pl": "PLN", "ro": "RON", "hu": "HUF", "no": "NOK", "ru": "RUB", "tr": "TRY",
+    "jp": "JPY", "cn": "CNY", "kr": "KRW", "hk": "HKD", "in": "INR", "id": "IDR", "sg": "SGD",
+    "ph": "PHP", "th": "THB", "my": "MYR", "za": "ZAR", "sa": "SAR", "ae": "AED", "qa": "QAR",
+    "kw": "KWD", "bh": "BHD", "om": "OMR", "lb": "USD",
+}
+
+# Unambiguous symbols, longest first so "R$" wins over "$"
+SYMBOLS = [
+    ("US$", "USD"), ("HK$", "HKD"), ("NZ$", "NZD"), ("CA$", "CAD"), ("MX$", "MXN"), ("NT$", "TWD"),
+    ("R$", "BRL"), ("S$", "SGD"), ("A$", "AUD"), ("C$", "CAD"), ("zł", "PLN"), ("Rp", "IDR"), ("RM", "MYR"),
+    ("Ft", "HUF"), ("lei", "RON"), ("руб", "RUB"), ("€", "EUR"), ("£", "GBP"), ("₹", "INR"), ("₩", "KRW"),
+    ("₽", "RUB"), ("₺", "TRY"), ("₱", "PHP"), ("฿", "THB"), ("₪", "ILS"), ("円", "JPY"),
+]
+# Symbols shared by several currencies, the region decides, else the first one
+AMBIGUOUS_SYMBOLS = {
+    "$": ("USD", "CAD", "AUD", "NZD", "MXN", "ARS", "COP", "SGD", "HKD"),
+    "¥": ("JPY", "CNY"),
+    "kr": ("NOK", "SEK", "DKK"),
+}
+MINOR_DIGITS = {"JPY": 0, "KRW": 0, "VND": 0, "CLP": 0, "ISK": 0, "BHD": 3, "KWD": 3, "OMR": 3}
+
+FREE_WORDS = ("free", "gratis", "gratuit", "kostenlos", "grátis", "無料", "免费")
+UNAVAILABLE_WORDS = ("not available", "unavailable", "não disponível", "no disponible", "nicht verfügbar")
+NUMBER = re.compile(r"\d[\d.,'\s\u00a0\u202f]*")
+CURRENCY_CODE = re.compile(r"\b[A-Z]{3}\b")
+
+def minor_digits(currency):
+    return MINOR_DIGITS.get(currency, 2)
+
+def region_currency(region):
+    return REGION_CURRENCIES.get(region)
+
+def detect_currency(text, region=None):
+    default = region_currency(region)
+    for code in CURRENCY_CODE.findall(text):
+        if code in MINOR_DIGITS or code in REGION_CURRENCIES.values():
+            return code
+    for symbol, currency in SYMBOLS:
+        if symbol in text:
+            return currency
+    for symbol, currencies in AMBIGUOUS_SYMBOLS.items():
+        if symbol in text:
+            return default if default in currencies else currencies[0]
+    return default
+
+# "1.234,56", "1,234.56", "49,90", "1,234" and "108 999" all read the way the store meant them
+def parse_amount(text, currency):
+    numbers = NUMBER.findall(text)
+    if not numbers:
+        return None
+    number = re.sub(r"['\s\u00a0\u202f]", "", numbers[-1]).rstrip(".,")  # The last one is the current price of a sale
+    if "," in number and "." in number:
+        decimal = "," if number.rfind(",") > number.rfind(".") else "."
+        number = number.replace("." if decimal == "," else ",", "").replace(decimal, ".")
+    else:
+        separator = "," if "," in number else "." if "." in number else None
+        if separator:
+            parts = number.split(separator)
+            decimals = len(parts[-1])
+            if len(parts) == 2 and (decimals != 3 or minor_digits(currency) == 3):
+                number = ".".join(parts)
+            else:
+                number = "".join(parts)
+    try:
+        return round(float(number) * 10 ** minor_digits(currency))
+    except ValueError:
+        return None
+
+def parse_price(text, region=None):
+    if not isinstance(text, str) or text.strip() in ("", "N/A"):
+        return {"amount_minor": None, "currency": None, "status": UNKNOWN}
+    lower = text.lower()
+    has_digits = any(char.isdigit() for char in text)
+    if any(word in lower for word in UNAVAILABLE_WORDS):
+        return {"amount_minor": None, "currency": None, "status": UNAVAILABLE}
+    if not has_digits and any(word in lower for word in FREE_WORDS):
+        return {"amount_minor": 0, "currency": region_currency(region), "status": FREE}
+
+    currency = detect_currency(text, region)
+    amount = parse_amount(text, currency) if has_digits else None
+    if amount is None or currency is None:
+        return {"amount_minor": None, "currency": currency, "status": UNKNOWN}
+    if amount == 0:
+        return {"amount_minor": 0, "currency": currency, "status": FREE}
+    return {"amount_minor": amount, "currency": currency, "status": PRICED}
+
+# {region: parsed price} of a game's prices map
+def parse_prices(prices):
+    return {region: parse_price(text, region) for region, text in (prices or {}).items()}
+
+# Major units as given in the API (e.g. "19.99") to the minor units stored for a region
+def to_minor(amount, region):
+    return round(float(amount) * 10 ** minor_digits(region_currency(region)))
+
+# Units of each currency per unit of the base currency, from a local JSON file
+def load_fx_rates(path):
+    with open(path, encoding="utf-8") as f:
+        table = json.load(f)
+    return table["base"], table["rates"]
+
+# A parsed price in minor units of the base currency, None when there is no rate for it
+def convert(price, base, rates):
+    rate = rates.get(price["currency"])
+    if price["amount_minor"] is None or not rate:
+        return None
+    amount = price["amount_minor"] / 10 ** minor_digits(price["currency"]) / rate
+    return round(amount * 10 ** minor_digits(base))
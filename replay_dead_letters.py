@@ -0,0 +1,35 @@
+import sys
+import importlib
+from utils import get_mongo_db, load_dead_letters, resolve_dead_letters, write_dead_letters, bump_generation, log_info
+
+# Runs only the dead-letter items of a store again and upserts them into the live collection.
+# Usage: python replay_dead_letters.py <steam|playstation|xbox|nintendo> [--all]
+# Permanent failures are skipped unless --all is given.
+STORES = ("steam", "playstation", "xbox", "nintendo")
+
+def replay_store(store, include_permanent=False):
+    collection_name = f"{store}_games"
+    db = get_mongo_db()
+    entries = load_dead_letters(db, collection_name, include_permanent)
+    if not entries:
+        log_info(f"{collection_name} : no dead letters to replay")
+        return
+
+    log_info(f"{collection_name} : replaying {len(entries)} dead letters")
+    scraper = importlib.import_module(f"scraper_{store}")
+    failures = scraper.replay(entries)
+    resolve_dead_letters(db, collection_name, [key for key, _ in entries if key not in failures])
+    write_dead_letters(db, collection_name, failures)
+    bump_generation(db, collection_name)
+    log_info(f"{collection_name} : {len(entries) - len(failures)} recovered, {len(failures)} still failing")
+
+def main():
+    stores = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if not stores or any(store not in STORES for store in stores):
+        print(f"Usage: python replay_dead_letters.py <{'|'.join(STORES)}>... [--all]")
+        return
+    for store in stores:
+        replay_store(store, "--all" in sys.argv)
+
+if __name__ == "__main__":
+    main()
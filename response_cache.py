@@ -0,0 +1,87 @@
+import os
+import time
+import hashlib
+import threading
+import collections
+from urllib.parse import urlencode
+
+# Optional shared cache for several API processes
+try:
+    import redis
+except ImportError:
+    redis = None
+
+response_cache_size = int(os.getenv("response_cache_size", 1000))  # Responses kept in process
+response_cache_ttl = int(os.getenv("response_cache_ttl", 3600))  # Seconds, the generation invalidates sooner
+generation_check_seconds = float(os.getenv("generation_check_seconds", 2))  # How stale a generation may be
+redis_url = os.getenv("redis_url")
+
+# Generation number of each game collection, bumped by update_mongo when new data goes live.
+# Cache keys contain it, so a bump makes every cached response of the collection unreachable.
+class Generations:
+    def __init__(self, collection):
+        self.collection = collection
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        now = time.monotonic()
+        with self.lock:
+            value, checked = self.values.get(name, (None, 0))
+        if now - checked > generation_check_seconds:
+            doc = self.collection.find_one({"_id": name}) or {}
+            value = doc.get("generation", 0)
+            with self.lock:
+                self.values[name] = (value, now)
+        return value
+
+def cache_key(path, collection_name, generation, args):
+    params = urlencode(sorted(args.items(multi=True)))
+    return f"{path}:{collection_name}:{generation}:{params}"
+
+def etag(body):
+    return f'"{hashlib.sha1(body).hexdigest()}"'
+
+# LRU of (etag, body) in process, backed by Redis when redis_url is set
+class ResponseCache:
+    def __init__(self, size=response_cache_size, ttl=response_cache_ttl, url=redis_url):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.redis = redis.Redis.from_url(url) if url and redis is not None else None
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+        if self.redis is not None:
+            try:
+                value = self.redis.get(key)
+            except redis.RedisError:
+                value = None
+            if value is not None:
+                tag, body = value.split(b"\n", 1)
+                entry = (tag.decode(), body)
+                self._remember(key, entry)
+                return entry
+        return None
+
+    def set(self, key, body):
+        entry = (etag(body), body)
+        self._remember(key, entry)
+        if self.redis is not None:
+            try:
+                self.redis.set(key, entry[0].encode() + b"\n" + body, ex=self.ttl)
+            except redis.RedisError:
+                pass
+        return entry
+
+    def _remember(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
@@ -4,47 +4,130 @@ import platform
 import subprocess
 from utils import log_info
 
-# Define the scraper order and their respective wait intervals (in seconds)
-SCRAPER_ORDER = [
-    ("scraper_nintendo.py", 10),
-    ("scraper_playstation.py", 10),
-    ("scraper_xbox.py", 10),
-    ("scraper_steam.py", 10),
+# Stores run side by side, each on its own interval, as long as their combined cost fits
+# the budget. Lower priority numbers start first when several stores are due.
+# cost: worker processes, Selenium browsers and share of the proxy pool a run takes. The
+# share is passed to the scraper as its own slice of the proxy list, see proxy_slice.
+STORES = [
+    {"name": "steam", "script": "scraper_steam.py", "priority": 0,
+     "interval": float(os.getenv("steam_interval_minutes", 60)) * 60,
+     "cost": {"processes": 1, "browsers": 0, "proxy_share": 0.5}},
+    {"name": "playstation", "script": "scraper_playstation.py", "priority": 1,
+     "interval": float(os.getenv("playstation_interval_minutes", 360)) * 60,
+     "cost": {"processes": 220, "browsers": 0, "proxy_share": 0.5}},
+    {"name": "xbox", "script": "scraper_xbox.py", "priority": 2,
+     "interval": float(os.getenv("xbox_interval_minutes", 360)) * 60,
+     "cost": {"processes": 20, "browsers": 20, "proxy_share": 0}},
+    {"name": "nintendo", "script": "scraper_nintendo.py", "priority": 3,
+     "interval": float(os.getenv("nintendo_interval_minutes", 720)) * 60,
+     "cost": {"processes": 10, "browsers": 10, "proxy_share": 0}},
 ]
 
-def run_scraper(scraper, interval):
-    try:
-        log_info(f"========== Starting {scraper}... ==========")
+BUDGET = {
+    "processes": int(os.getenv("scheduler_max_processes", 256)),
+    "browsers": int(os.getenv("scheduler_max_browsers", 30)),
+    "proxy_share": float(os.getenv("scheduler_proxy_share", 1.0)),
+}
+tick_seconds = 5  # How often finished runs are collected and due stores started
 
-        if platform.system() == "Windows":
-            # On Windows, use CREATE_NEW_PROCESS_GROUP
-            proc = subprocess.Popen(
-                ["python", scraper],
-                creationflags=subprocess.CREATE_NEW_PROCESS_GROUP
-            )
-        else:
-            # On Unix-based systems, use os.setsid()
-            proc = subprocess.Popen(
-                ["python3", scraper],  # Use "python3" for Unix-based systems
-                preexec_fn=os.setsid
-            )
+# Part of the proxy list a store uses, as "start:end" fractions. Stores are laid out one
+# after the other by proxy_share, so stores that fit the budget together never share a proxy.
+def proxy_slice(store, stores=STORES):
+    start = 0.0
+    for other in stores:
+        if other is store:
+            break
+        start += other["cost"]["proxy_share"]
+    return f"{start:g}:{start + store['cost']['proxy_share']:g}"
 
-        log_info(f"Process {scraper} started with PID {proc.pid}")
+def start_scraper(scraper, env=None):
+    log_info(f"========== Starting {scraper}... ==========")
+    env = {**os.environ, **(env or {})}
+    if platform.system() == "Windows":
+        # On Windows, use CREATE_NEW_PROCESS_GROUP
+        proc = subprocess.Popen(
+            ["python", scraper],
+            creationflags=subprocess.CREATE_NEW_PROCESS_GROUP,
+            env=env
+        )
+    else:
+        # On Unix-based systems, use os.setsid()
+        proc = subprocess.Popen(
+            ["python3", scraper],  # Use "python3" for Unix-based systems
+            preexec_fn=os.setsid,
+            env=env
+        )
+    log_info(f"Process {scraper} started with PID {proc.pid}")
+    return proc
 
-        proc.wait()
+def in_use(running):
+    return {resource: sum(store["cost"][resource] for store in running) for resource in BUDGET}
 
-        log_info(f"========== Finished {scraper} and Updated db. ==========")
+# A store bigger than the whole budget still runs, alone
+def fits(store, running):
+    if not running:
+        return True
+    used = in_use(running)
+    return all(used[resource] + store["cost"][resource] <= BUDGET[resource] for resource in BUDGET)
 
-    except Exception as e:
-        print(f"Scheduler.py : Error running {scraper}: {e}")
-        time.sleep(60)  # Wait before retrying in case of an error
+class Scheduler:
+    def __init__(self, stores=STORES):
+        self.stores = stores
+        self.next_due = {store["name"]: 0.0 for store in stores}  # Everything runs once at start
+        self.procs = {}  # Running process by store name
+        self.started = {}
+        self.skipped = set()  # Stores whose slot came while they were still running
 
-    time.sleep(interval)
+    def reap(self, now):
+        for name, proc in list(self.procs.items()):
+            code = proc.poll()
+            if code is None:
+                continue
+            del self.procs[name]
+            store = next(store for store in self.stores if store["name"] == name)
+            log_info(f"========== Finished {store['script']} with code {code} in {(now - self.started[name]) / 60:.1f} min ==========")
+            if name in self.skipped:
+                # The slots missed while running are coalesced into one run, started right away
+                self.skipped.discard(name)
+                self.next_due[name] = now
+
+    # Due stores in priority order. When the first one does not fit, lower priorities
+    # wait too, so a big store is not starved by small ones.
+    def start_due(self, now):
+        running = [store for store in self.stores if store["name"] in self.procs]
+        due = sorted(
+            (store for store in self.stores if self.next_due[store["name"]] <= now),
+            key=lambda store: store["priority"]
+        )
+        for store in due:
+            name = store["name"]
+            if name in self.procs:
+                if name not in self.skipped:
+                    log_info(f"Scheduler : {name} is still running, its next run is coalesced")
+                    self.skipped.add(name)
+                continue
+            if not fits(store, running):
+                break
+            try:
+                env = {"proxy_slice": proxy_slice(store, self.stores)} if store["cost"]["proxy_share"] else None
+                self.procs[name] = start_scraper(store["script"], env)
+            except Exception as e:
+                print(f"Scheduler.py : Error running {store['script']}: {e}")
+                self.next_due[name] = now + 60  # Wait before retrying in case of an error
+                continue
+            self.started[name] = now
+            self.next_due[name] = now + store["interval"]
+            running.append(store)
+
+    def run(self):
+        while True:
+            now = time.monotonic()
+            self.reap(now)
+            self.start_due(now)
+            time.sleep(tick_seconds)
 
 def main():
-    while True:        
-        for scraper, interval in SCRAPER_ORDER:
-            run_scraper(scraper, interval)
+    Scheduler().run()
 
 if __name__ == "__main__":
     main()
@@ -1,14 +1,22 @@
 import requests
 import time
-import re
 import multiprocessing
+from datetime import datetime, timezone
 from bs4 import BeautifulSoup
-from utils import log_info, get_mongo_db, save_to_mongo, update_mongo, get_selenium_browser, search_game, regions_nintendo
+from nintendo_prices import normalize_title, region_code, build_price_index, save_price_index, load_price_index
+from utils import (
+    log_info, get_mongo_db, MongoWriter, update_mongo, BrowserPool, search_game, rate_limited_browse, PermanentError, is_permanent,
+    write_dead_letters, mark_failures_seen, start_work_manager,
+    fill_work_queue, log_work_stats, regions_nintendo
+)
 
 n_processes = 10
 
 API_URL = "https://api.sampleapis.com/switch/games" # API endpoint
+GAME_FIELDS = ("name", "genre", "publishers", "releaseDates")  # Fields of the API games the workers need
 JAPAN_URL = "https://www.nintendo.com/jp/software/switch/index.html?sftab=all"
+JAPAN_SEARCH_DOM = 'input[class="nc3-c-search__boxText nc3-js-megadrop__focusable nc3-js-searchBox__text"]'
+JAPAN_RESULT_DOM = 'div[class="nc3-c-softCard__listItemPrice"]'
 
 def fetch_games():
     try:
@@ -20,118 +28,154 @@ def fetch_games():
         time.sleep(60)
         return []
 
-def process_nintendo_game(browser, game):
+# Store search of one EU region, only used when the region is missing from the price index
+def search_region_price(browser, region_url, title, limiter=None):
+    rate_limited_browse(browser, region_url, limiter)
+    soup = search_game(browser, 'input[type="search"]', 'span[class=""]', title)
+    if not soup:
+        return ""
+    tmp = soup.find_all('ul', class_="results")[-1]
+    tmp = tmp.find('li', class_="searchresult_row page-list-group-item col-xs-12")
+    tmp = tmp.find('p', class_='price-small')
+    return tmp.find_all('span')[-1].text.strip() if tmp else ""
+
+def search_japan_price(browser, title, limiter=None):
+    rate_limited_browse(browser, JAPAN_URL, limiter)
+    soup = search_game(browser, JAPAN_SEARCH_DOM, JAPAN_RESULT_DOM, title)
+    price = soup.find('div', class_='nc3-c-softCard__listItemPrice') if soup else ""
+    return price.text.strip() if price else ""
+
+# US store slug of a game, its key in the collection, the work queue and the dead letters
+def game_slug(title):
+    return normalize_title(title) + "-switch"
+
+def process_nintendo_game(browser, game, limiter=None):
     # retrieve data by api
     title = game.get("name", "N/A")
     categories = game.get("genre", [])
     publisher = game.get("publishers")[0] if game.get("publishers") else "N/A"
-    release_date = game.get("releaseDates", {})['NorthAmerica']
+    release_date = game.get("releaseDates", {}).get('NorthAmerica', "N/A")
     
-    tmp = title.replace("&", "and")
-    tmp = tmp.lower()
-    tmp = re.sub(r'[^a-z0-9 ]', '', tmp)
-    tmp = tmp.replace(" ","-")
+    key = normalize_title(title)
+    slug = game_slug(title)
+    price_index = load_price_index()
 
-    game_link = "https://www.nintendo.com/us/store/products/" + tmp + "-switch/"
+    game_link = "https://www.nintendo.com/us/store/products/" + slug + "/"
     
-    while True:
-        try:
-            browser.get(game_link)
-            soup = BeautifulSoup(browser.page_source, "html.parser")
-
-            # cover image
-            tmp = soup.find('img',{'alt': title + " 1"})
-            header_image = tmp['src'] if tmp else "No Game Header Imgae"
-
-            # Rating
-            tmp = soup.find('h3', string='ESRB rating')
-            rating = tmp.find_next('div').find('a').text.strip() if tmp else "No Rating"
-
-            # Short description
-            tmp = soup.find('meta', {'name':'description'})['content']
-            short_description = tmp if tmp else "No Short Description"
-
-            # Platform
-            tmp = soup.find('div', class_='sc-1i9d4nw-14 gxzajP')
-            platforms = tmp.find('span').get_text() if tmp else "No platform"
-
-            # Screenshots 
-            tmp = soup.find('div', {'class' : '-fzAB SUqIq'})
-            screenshots = [img['src'] for img in tmp.find_all('img')] if tmp else []
-
-            # Prices in different regions
-            prices = {}
-            # USA
-            tmp = (soup.find('span', class_='W990N QS4uJ') or soup.find('div', class_='o2BsP QS4uJ'))
-            tmp = tmp.text.strip() if tmp else ""
-            prices["us"] = tmp.split(':')[-1].strip() if tmp else "NOT AVAILABLE SEPARATELY"
-
-            # Brazil
-            browser.get(game_link.replace("/us/",'/pt-br/'))
-            soup = BeautifulSoup(browser.page_source, 'html.parser')
-            tmp = (soup.find('span', class_='W990N QS4uJ') or soup.find('div', class_='o2BsP QS4uJ'))
-            tmp = tmp.text.strip().replace('\xa0',' ') if tmp else ""
-            prices['br'] = tmp.split(':')[-1].strip() if tmp else "NOT AVAILABLE SEPARATSELY"
-
-            # EUA
-            index = 0
-            while index < len(regions_nintendo):
-                region_url = regions_nintendo[index]
-                if index < 3:
-                    browser.get(region_url)
-                    soup = search_game(browser, 'input[type="search"]', 'span[class=""]', title)
-                    if soup:
-                        tmp = soup.find_all('ul', class_="results")[-1]
-                        tmp = tmp.find('li', class_="searchresult_row page-list-group-item col-xs-12")
-                        tmp = tmp.find('p', class_='price-small')
-                        price = tmp.find_all('span')[-1].text.strip() if tmp else ""
-                        price.replace("*", ' ')
-                    else: price = ""
-                else:
-                    price = prices["de"]
-                prices[region_url.split('/')[3].split('-')[1]] = price if price else "NOT AVAILABLE SEPARATELY"
-                index += 1
-
-            # Japan
-            browser.get(JAPAN_URL)
-            search_dom = 'input[class="nc3-c-search__boxText nc3-js-megadrop__focusable nc3-js-searchBox__text"]'
-            result_dom = 'div[class="nc3-c-softCard__listItemPrice"]'
-            soup = search_game(browser, search_dom, result_dom, title)
-            price = soup.find('div', class_='nc3-c-softCard__listItemPrice') if soup else ""
-            prices['jp'] = price.text.strip() if price else "NOT AVAILABLE SEPARATELY"
-
-            game_data = {
-                    "title": title,                          
-                    "categories": categories,
-                    "short_description": short_description,
-                    "full_description": [],
-                    "screenshots": screenshots,
-                    "header_image": header_image,
-                    "rating": rating,
-                    "publisher": publisher,
-                    "platforms": platforms,
-                    "release_date": release_date,
-                    "prices": prices
-                }
-            return game_data
-        except Exception as e:
-            print(f"Don't worry. Fixing Error Nintendo game: {e}")
-            time.sleep(60)
-
-def process_games_range(start_index, end_index, games):
-    db = get_mongo_db()
-    browser = get_selenium_browser()
-
-    for index in range(start_index, end_index):
-        try:
-            game_data = process_nintendo_game(browser, games[index])
-            save_to_mongo(db, "nintendo_games", game_data)
-        except Exception as e:
-            print(f"Error processing game at index {index}: {str(e)}")
-
-    browser.quit()
+    rate_limited_browse(browser, game_link, limiter)
+    soup = BeautifulSoup(browser.page_source, "html.parser")
+
+    # cover image
+    tmp = soup.find('img',{'alt': title + " 1"})
+    header_image = tmp['src'] if tmp else "No Game Header Imgae"
+
+    # Rating
+    tmp = soup.find('h3', string='ESRB rating')
+    rating = tmp.find_next('div').find('a').text.strip() if tmp else "No Rating"
+
+    # Short description, product pages always have one, a missing one means the slug matches no product
+    tmp = soup.find('meta', {'name':'description'})
+    if tmp is None:
+        raise PermanentError(f"No product page at {game_link}")
+    short_description = tmp.get('content') or "No Short Description"
+
+    # Platform
+    tmp = soup.find('div', class_='sc-1i9d4nw-14 gxzajP')
+    platforms = tmp.find('span').get_text() if tmp else "No platform"
+
+    # Screenshots 
+    tmp = soup.find('div', {'class' : '-fzAB SUqIq'})
+    screenshots = [img['src'] for img in tmp.find_all('img')] if tmp else []
+
+    # Prices in different regions
+    prices = {}
+    # USA
+    tmp = (soup.find('span', class_='W990N QS4uJ') or soup.find('div', class_='o2BsP QS4uJ'))
+    tmp = tmp.text.strip() if tmp else ""
+    prices["us"] = tmp.split(':')[-1].strip() if tmp else "NOT AVAILABLE SEPARATELY"
+
+    # Brazil
+    rate_limited_browse(browser, game_link.replace("/us/",'/pt-br/'), limiter)
+    soup = BeautifulSoup(browser.page_source, 'html.parser')
+    tmp = (soup.find('span', class_='W990N QS4uJ') or soup.find('div', class_='o2BsP QS4uJ'))
+    tmp = tmp.text.strip().replace('\xa0',' ') if tmp else ""
+    prices['br'] = tmp.split(':')[-1].strip() if tmp else "NOT AVAILABLE SEPARATSELY"
+
+    # Europe and Japan from the price index, a lookup per region. Regions missing
+    # from the index are searched in the store like before.
+    for index, region_url in enumerate(regions_nintendo):
+        code = region_code(region_url)
+        if code in price_index:
+            price = price_index[code].get(key, "")
+        elif index < 3:
+            price = search_region_price(browser, region_url, title, limiter)
+        else:
+            price = prices["de"]
+        prices[code] = price if price else "NOT AVAILABLE SEPARATELY"
+
+    if "jp" in price_index:
+        price = price_index["jp"].get(key, "")
+    else:
+        price = search_japan_price(browser, title, limiter)
+    prices['jp'] = price if price else "NOT AVAILABLE SEPARATELY"
+
+    game_data = {
+            "slug": slug,
+            "title": title,                          
+            "categories": categories,
+            "short_description": short_description,
+            "full_description": [],
+            "screenshots": screenshots,
+            "header_image": header_image,
+            "rating": rating,
+            "publisher": publisher,
+            "platforms": platforms,
+            "release_date": release_date,
+            "prices": prices
+        }
+    return game_data
+
+# Each worker leases games from the shared queue until it is empty, at the page rate
+# of the limiter shared by all workers
+def process_games_queue(queue, limiter, mode=None):
+    with MongoWriter(get_mongo_db(), "nintendo_games", mode=mode) as writer, BrowserPool() as browser_pool:
+        while True:
+            lease = queue.lease()
+            if lease is None:
+                break
+            slug, game = lease
+            try:
+                with browser_pool.browser() as browser:
+                    game_data = process_nintendo_game(browser, game, limiter)
+                writer.add(game_data)
+                queue.ack(slug)
+            except Exception as e:
+                print(f"Error processing game {slug}: {str(e)}")
+                queue.fail(slug, f"{type(e).__name__}: {e}", is_permanent(e))
+
+# Runs the workers on dead-letter entries and upserts the games into the live collection.
+# Returns the failures of the items that failed again.
+def replay(entries):
+    manager = start_work_manager()
+    queue = manager.WorkQueue()
+    limiter = manager.RateLimiter()
+    queue.put_many(entries)
+    queue.close()
+    processes = [
+        multiprocessing.Process(target=process_games_queue, args=(queue, limiter, "incremental"))
+        for _ in range(min(n_processes, len(entries)))
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failures = queue.failures()
+    log_work_stats("Nintendo replay", queue)
+    manager.shutdown()
+    return failures
 
 def main():
+    run_started = datetime.now(timezone.utc)
     log_info("Waiting for fetching Nintendo games...")
     games = fetch_games()
 
@@ -140,23 +184,38 @@ def main():
         log_info("No games found to process.")
         return
     
-    # Calculate the ranges for each subprocess
-    chunk_size = (total_games + n_processes - 1) // n_processes
-    ranges = [(i * chunk_size, min((i + 1) * chunk_size, total_games)) for i in range(n_processes)]
+    # Regional prices of the whole catalogue, read by the workers from the index file
+    save_price_index(build_price_index())
+
+    # Shared queue the subprocesses take games from, keyed by slug so a dead letter still
+    # names the same game when the API list changes order. A slug listed twice is queued once.
+    manager = start_work_manager()
+    queue = manager.WorkQueue()
+    fill_work_queue(queue, [
+        (game_slug(game.get("name", "N/A")), {k: game[k] for k in GAME_FIELDS if k in game}) for game in games
+    ])
+    queue.close()
+    limiter = manager.RateLimiter()
+    del games  # Workers read their games from the queue
 
     # Create and start subprocesses
     processes = []
-    for start, end in ranges:
-        process = multiprocessing.Process(target=process_games_range, args=(start, end, games))
+    for _ in range(n_processes):
+        process = multiprocessing.Process(target=process_games_queue, args=(queue, limiter))
         processes.append(process)
         process.start()
 
     # Wait for all processes to complete
     for process in processes:
         process.join()
-
+    log_work_stats("Nintendo", queue)
     db = get_mongo_db()
-    update_mongo(db, "nintendo_games")
+    failures = queue.failures()
+    write_dead_letters(db, "nintendo_games", failures, run_started)
+    mark_failures_seen(db, "nintendo_games", failures)
+    manager.shutdown()
+
+    update_mongo(db, "nintendo_games", run_started)
     log_info("All Nintendo processes completed.")
 
 if __name__ == "__main__":
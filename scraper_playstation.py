@@ -3,20 +3,22 @@ import requests
 import multiprocessing
 import re
 import time
-import itertools
-from utils import log_info, save_to_mongo, get_mongo_db, update_mongo, regions_playstation
-from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from parsers import SelectorSet, extract_playstation_json, PLAYSTATION_GAME_FIELDS, PLAYSTATION_PRICE_FIELDS, PLAYSTATION_PRICE_MARKER
+from utils import (
+    log_info, MongoWriter, get_mongo_db, update_mongo, ProxiedClient, load_proxies, backoff_delay, start_work_manager,
+    log_work_stats, log_proxy_stats, is_permanent, write_dead_letters, mark_failures_seen, work_max_attempts, http_cache_stats, log_http_cache_stats, regions_playstation
+)
 
 n_processes = 200  # Adjust based on your system's performance
+n_listing_processes = 20  # Processes crawling the browse pages, they feed the n_processes detail workers
+game_queue_size = 5000  # Games waiting for a detail worker before the listing pauses
+region_concurrency = 8  # Regional price pages fetched at once for a game
+region_retries = 3  # Attempts per regional price page
+game_price_deadline = 120  # Seconds for all regional prices of a game
 PLAYSTATION_URL = "https://store.playstation.com/en-us/pages/browse/1"
 
-# Load proxies from file
-with open("proxies.txt") as f:
-    PROXIES = [line.strip() for line in f if line.strip()]
-
-chunk_size = (len(PROXIES) + n_processes - 1) // n_processes
-proxy_chunks = [PROXIES[i * chunk_size:(i + 1) * chunk_size] for i in range(n_processes)]
-
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36",
     "Accept-Language": "en-US,en;q=0.9",
@@ -28,141 +30,202 @@ HEADERS = {
     "Connection": "keep-alive"
 }
 
-# Set up a requests session with proxy and retry logic
-def create_session(proxy_list):
-    proxy = next(itertools.cycle(proxy_list))
-    session = requests.Session()
-    session.proxies = {"http": proxy, "https": proxy}
-    session.headers.update(HEADERS)
-    session.mount('https://', HTTPAdapter(max_retries=3))
-    return session
+# Selectors of the concept page and of the regional price pages, compiled once
+GAME_SELECTORS = SelectorSet(PLAYSTATION_GAME_FIELDS)
+PRICE_SELECTORS = SelectorSet(PLAYSTATION_PRICE_FIELDS)
 
-def get_total_pages(proxy_list):
-    while True:
+# GET through a healthy proxy of the shared manager at the rate allowed for it, on its pooled session
+def fetch(url, client, timeout=30):
+    return client.get(url, timeout)
+
+# Tries work_max_attempts times with another proxy each time, None when all fail
+def get_total_pages(client):
+    for attempt in range(work_max_attempts):
         try:
-            session = create_session(proxy_list)
-            response = session.get(PLAYSTATION_URL, timeout=30)
-            response.raise_for_status()
+            response = fetch(PLAYSTATION_URL, client)
             soup = BeautifulSoup(response.content, "html.parser")
             ol_tag = soup.select_one('ol.psw-l-space-x-1.psw-l-line-center.psw-list-style-none')
             total_pages = int(ol_tag.select('li')[-1].find('span', class_="psw-fill-x").text.strip())
             return total_pages
         except requests.exceptions.HTTPError as e:
             print(f"Error fetching total pages: {e}")
-            if response.status_code == 403:
+            if is_permanent(e):
+                return None
+            if e.response.status_code == 403:
                 print("Access denied. Trying with a new proxy...")
-                time.sleep(10)
-                continue
-            break
         except Exception as e:
             print(f"Unexpected error: {e}")
-            time.sleep(10)
-            continue
-
-def fetch_page_links(start_page, end_page, proxy_list):
-    links = []
-    for i in range(start_page, end_page):
+        time.sleep(backoff_delay(attempt, base=10))
+    return None
+
+def concept_id(link):
+    return re.search(r"/concept/(\d+)", link).group(1)
+
+def fetch_page_links(page, client):
+    url = f"https://store.playstation.com/en-us/pages/browse/{page}"
+    response = fetch(url, client)
+    soup = BeautifulSoup(response.content, "html.parser")
+    all_links = [a['href'] for a in soup.find_all('a', href=True)]
+    return [link for link in all_links if re.match(r"/en-us/concept/\d+", link)]
+
+# Each listing worker leases browse pages and streams their concept links into the game
+# queue, which drops concepts already seen on other pages and blocks while it is full
+def list_pages_queue(page_queue, game_queue, client):
+    while True:
+        lease = page_queue.lease()
+        if lease is None:
+            break
+        page, _ = lease
         try:
-            url = f"https://store.playstation.com/en-us/pages/browse/{i + 1}"
-            session = create_session(proxy_list)
-            response = session.get(url, timeout=30)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.content, "html.parser")
-            all_links = [a['href'] for a in soup.find_all('a', href=True)]
-            filtered_links = [link for link in all_links if re.match(r"/en-us/concept/\d+", link)]
-            links.extend(filtered_links)
+            links = fetch_page_links(page, client)
+            game_queue.put_many([(concept_id(link), link) for link in links])
+            page_queue.ack(page)
+        except requests.RequestException as e:
+            print(f"Error fetching page {page}: {e}")
+            page_queue.fail(page, str(e), is_permanent(e))
+
+# Errors are left to the worker, which retries or dead-letters the game
+def process_playstation_game(game, client):
+    response = fetch(f"https://store.playstation.com{game}", client)
+
+    # Embedded JSON first, the DOM when the page has none
+    game_details = {"concept_id": concept_id(game)}
+    game_details.update(extract_playstation_json(response.content) or GAME_SELECTORS.extract(response.content))
+    game_details["prices"], game_details["price_status"] = fetch_game_prices(game, client)
+    return game_details
+
+# Returns (price, status) of one region, status is "ok" or "failed" once the retries or the
+# game deadline run out
+def fetch_region_price(game, region, client, deadline):
+    region_url = f"https://store.playstation.com{game.replace('en-us', region)}"
+    for attempt in range(region_retries):
+        try:
+            response = fetch(region_url, client, timeout=min(30, max(deadline - time.monotonic(), 1)))
+            return PRICE_SELECTORS.extract_fragment(response.content, "price", PLAYSTATION_PRICE_MARKER), "ok"
         except requests.RequestException as e:
-            print(f"Error fetching page {i + 1}: {e}")
-    return links
-
-def fetch_playstation_games(total_pages):
-    chunk_size = (total_pages + n_processes - 1) // n_processes
-    ranges = [(i * chunk_size, min((i + 1) * chunk_size, total_pages)) for i in range(n_processes)]
-
-    with multiprocessing.Pool(processes=n_processes) as pool:
-        results = pool.starmap(fetch_page_links, [(start, end, proxy_chunks[i]) for i, (start, end) in enumerate(ranges)])
-
-    return [link for sublist in results for link in sublist]
-
-def process_playstation_game(game, proxy_list):
-    try:
-        url = f"https://store.playstation.com{game}"
-        session = create_session(proxy_list)
-        response = session.get(url, timeout=30)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.content, "html.parser")
-
-        def get_text_safe(tag):
-            return tag.text.strip() if tag else "N/A"
-
-        game_details = {
-            "title": get_text_safe(soup.find(attrs={"data-qa": "mfe-game-title#name"})),
-            "short_description": get_text_safe(soup.find(attrs={"class": "psw-l-switcher psw-with-dividers"})),
-            "full_description": get_text_safe(soup.find(attrs={"data-qa": "pdp#overview"})),
-            "header_image": soup.find('img', {'data-qa': 'gameBackgroundImage#heroImage#preview'})['src']
-                            if soup.find('img', {'data-qa': 'gameBackgroundImage#heroImage#preview'}) else "N/A",
-            "rating": get_text_safe(soup.find(attrs={"data-qa": "mfe-star-rating#overall-rating#average-rating"})),
-            "publisher": get_text_safe(soup.find(attrs={'data-qa': "gameInfo#releaseInformation#publisher-value"})),
-            "platforms": get_text_safe(soup.find(attrs={'data-qa': 'gameInfo#releaseInformation#platform-value'})),
-            "release_date": get_text_safe(soup.find(attrs={'data-qa': 'gameInfo#releaseInformation#releaseDate-value'})),
-            "categories": [span.text.strip() for span in soup.find(attrs={'data-qa': 'gameInfo#releaseInformation#genre-value'}).find_all('span')] if soup.find(attrs={'data-qa': 'gameInfo#releaseInformation#genre-value'}) else [],
-            "prices": fetch_game_prices(game, proxy_list),
-        }
-        return game_details
-    except requests.RequestException as e:
-        print(f"Network error fetching game {game}: {e}")
-    except Exception as e:
-        print(f"Error processing game {game}: {e}")
-
-def fetch_game_prices(game, proxy_list):
+            delay = backoff_delay(attempt)
+            if attempt == region_retries - 1 or time.monotonic() + delay >= deadline:
+                print(f"Error fetching price of {game} in {region}: {e}")
+                break
+            time.sleep(delay)
+    return "Not Available", "failed"
+
+# Fetches all regions at once, region_concurrency at a time. Regions not done by the game
+# deadline are recorded as "timeout" instead of holding up the worker.
+def fetch_game_prices(game, client):
     prices = {"us": "N/A"}
-    for region in regions_playstation:
+    price_status = {}
+    deadline = time.monotonic() + game_price_deadline
+    executor = ThreadPoolExecutor(max_workers=region_concurrency)
+    futures = {executor.submit(fetch_region_price, game, region, client, deadline): region for region in regions_playstation}
+    done, _ = wait(futures, timeout=game_price_deadline)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    for future, region in futures.items():
+        code = region.split('-')[1]
+        if future in done:
+            prices[code], price_status[code] = future.result()
+        else:
+            prices[code], price_status[code] = "Not Available", "timeout"
+    return prices, price_status
+
+# Each worker leases games from the shared queue until it is empty
+def process_games_queue(queue, client, mode=None):
+    with MongoWriter(get_mongo_db(), "playstation_games", mode=mode) as writer:
         while True:
-            try:
-                region_url = f"https://store.playstation.com{game.replace('en-us', region)}"
-                session = create_session(proxy_list)
-                response = session.get(region_url, timeout=30)
-                response.raise_for_status()
-                soup = BeautifulSoup(response.content, "html.parser")
-                price_tag = soup.find(attrs={"data-qa": "mfeCtaMain#offer0#finalPrice"})
-                prices[region.split('-')[1]] = price_tag.text.strip() if price_tag else "Not Available"
+            lease = queue.lease()
+            if lease is None:
                 break
-            except requests.RequestException as e:
-                time.sleep(5)
-    return prices
-
-def process_games_range(start_index, end_index, games, proxy_list):
-    db = get_mongo_db()
-
-    for index in range(start_index, end_index):
-        try:
-            game_data = process_playstation_game(games[index], proxy_list)
-            if game_data:
-                save_to_mongo(db, "playstation_games", game_data)
-            else:
-                print(f"Missing data for game {index}")
-        except Exception as e:
-            print(f"Error processing game at index {index}: {e}")
+            key, game = lease
+            try:
+                writer.add(process_playstation_game(game, client))
+                queue.ack(key)
+            except Exception as e:
+                print(f"Error processing game {game}: {e}")
+                queue.fail(key, f"{type(e).__name__}: {e}", is_permanent(e))
+
+def start_client(manager):
+    proxy_manager = manager.ProxyManager(load_proxies())  # Proxy health shared by all workers
+    limiter = manager.RateLimiter()  # Request rate per (host, proxy) shared by all workers
+    return proxy_manager, ProxiedClient(proxy_manager, limiter, HEADERS)
+
+# Runs the detail workers on dead-letter entries and upserts the games into the live
+# collection. Returns the failures of the items that failed again.
+def replay(entries):
+    manager = start_work_manager()
+    proxy_manager, client = start_client(manager)
+    queue = manager.WorkQueue()
+    queue.put_many(entries)
+    queue.close()
+    processes = [
+        multiprocessing.Process(target=process_games_queue, args=(queue, client, "incremental"))
+        for _ in range(min(n_processes, len(entries)))
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failures = queue.failures()
+    log_work_stats("Playstation replay", queue)
+    manager.shutdown()
+    return failures
 
 def main():
+    run_started = datetime.now(timezone.utc)
     log_info("Waiting for fetching Playstation games...")
-    total_pages = get_total_pages(PROXIES)
-    games = fetch_playstation_games(total_pages)
-
-    total_games = len(games)
-    if total_games == 0:
+    cache_before = http_cache_stats()
+    manager = start_work_manager()
+    proxy_manager, client = start_client(manager)
+    total_pages = get_total_pages(client)
+    if not total_pages:
         log_info("No games found to process.")
+        manager.shutdown()
         return
 
-    log_info(f"Fetched {total_games} games in Playstation.")
-    chunk_size = (total_games + n_processes - 1) // n_processes
-    ranges = [(i * chunk_size, min((i + 1) * chunk_size, total_games)) for i in range(n_processes)]
+    # Listing and detail workers run at the same time, connected by the game queue
+    page_queue = manager.WorkQueue()
+    page_queue.put_many([(page, page) for page in range(1, total_pages + 1)])
+    page_queue.close()
+    game_queue = manager.WorkQueue(max_pending=game_queue_size)
+
+    listing_processes = [
+        multiprocessing.Process(target=list_pages_queue, args=(page_queue, game_queue, client))
+        for _ in range(n_listing_processes)
+    ]
+    detail_processes = [
+        multiprocessing.Process(target=process_games_queue, args=(game_queue, client))
+        for _ in range(n_processes)
+    ]
+    for process in listing_processes + detail_processes:
+        process.start()
+
+    for process in listing_processes:
+        process.join()
+    game_queue.close()
+    log_work_stats("Playstation pages", page_queue)
+
+    for process in detail_processes:
+        process.join()
+    stats = game_queue.stats()
+    log_work_stats("Playstation", game_queue)
+    log_proxy_stats("Playstation", proxy_manager)
+    log_http_cache_stats("Playstation", cache_before)
+    db = get_mongo_db()
+    failures = game_queue.failures()
+    write_dead_letters(db, "playstation_games", failures, run_started)
+    mark_failures_seen(db, "playstation_games", failures)
+    failed_pages = len(page_queue.failures())
+    manager.shutdown()
 
-    with multiprocessing.Pool(processes=n_processes) as pool:
-        pool.starmap(process_games_range, [(start, end, games, proxy_chunks[i]) for i, (start, end) in enumerate(ranges)])
+    if stats["done"] == 0:
+        log_info("No games found to process.")
+        return
+    if failed_pages:
+        # The games of those pages were not listed, they are not gone from the store
+        log_info(f"Playstation : {failed_pages} listing pages failed, no games are marked as stale.")
+        run_started = None
 
-    db = get_mongo_db()
-    update_mongo(db, "playstation_games")
+    update_mongo(db, "playstation_games", run_started)
     log_info("All Playstation processes completed.")
 
 if __name__ == "__main__":
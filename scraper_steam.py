@@ -1,48 +1,181 @@
-import multiprocessing
-import requests
-from requests.adapters import HTTPAdapter
-from utils import save_to_mongo, get_mongo_db, update_mongo, log_info, regions_steam
-import itertools
+import os
+import json
+import time
+import sqlite3
+import asyncio
+from datetime import datetime, timezone
+import aiohttp
+from pymongo import UpdateOne
+from http_cache import HttpCache, cache_key, get_http_cache
+from utils import (
+    MongoWriter, ProxyManager, RateLimiter, get_mongo_db, update_mongo, mark_seen, mark_failures_seen, content_hash, load_proxies, proxy_ok,
+    failure_record, write_dead_letters, PERMANENT_STATUSES,
+    log_proxy_stats, http_cache_stats, log_http_cache_stats, log_info, regions_steam, http_pool_maxsize, http_keepalive, mongo_batch_size, write_mode
+)
 
-n_processes = 100  # Define number of processes
+n_workers = 100  # Number of apps processed at the same time
+max_concurrency = int(os.getenv("steam_concurrency", 200))  # Global limit of in-flight Steam requests
+price_batch_size = int(os.getenv("steam_price_batch", 100))  # Apps priced per appdetails request
 STEAM_API_URL = "https://api.steampowered.com/ISteamApps/GetAppList/v2/"
+STORE_APP_LIST_URL = "https://api.steampowered.com/IStoreService/GetAppList/v1/"  # Has last_modified, needs a key
+STEAM_API_KEY = os.getenv("steam_api_key")
+APP_DETAILS_URL = "https://store.steampowered.com/api/appdetails"
+HEADERS = {"User-Agent": "Mozilla/5.0"}  # Add a user agent for better response handling
 
-# Load proxies efficiently
-with open("proxies.txt") as f:
-    PROXIES = [line.strip() for line in f if line.strip()]
-proxy_pool = itertools.cycle(PROXIES)  # Efficient round-robin proxy cycling
+# Delta crawl, only used with write_mode=incremental
+INDEX_COLLECTION = "steam_index"
+steam_refresh_hours = float(os.getenv("steam_refresh_hours", 72))  # Age after which a known app is fetched again
+steam_max_refresh = int(os.getenv("steam_max_refresh", 0))  # Max known apps refreshed per run, 0 for no limit
 
-# Set up a requests session with proxy
-def create_session(proxy):
-    session = requests.Session()
-    session.proxies = {"http": proxy, "https": proxy}
-    session.headers.update({"User-Agent": "Mozilla/5.0"})  # Add a user agent for better response handling
-    session.mount('https://', HTTPAdapter(max_retries=3))  # Retry on failure
-    return session
+# Every request picks a healthy proxy and waits for a token of its (host, proxy) bucket
+proxy_manager = ProxyManager(load_proxies())
+rate_limiter = RateLimiter()
 
-def fetch_steam_apps(session):
+# One shared HTTP session for the whole run, aiohttp keeps the connections of each (host, proxy) alive
+def create_session():
+    connector = aiohttp.TCPConnector(limit=max_concurrency, limit_per_host=http_pool_maxsize,
+                                     keepalive_timeout=http_keepalive)
+    return aiohttp.ClientSession(connector=connector, headers=HEADERS)
+
+# GET a JSON document through a proxy, at most max_concurrency requests run at once.
+# Each attempt takes a proxy from the manager, waits for the rate limiter outside the
+# semaphore, and reports back how it went to both. Throttled (429), blocked (403, 407) and
+# server errors are tried again like connection errors. The cached validators of the URL are sent along,
+# a 304 is answered from the HTTP cache. The cache works in SQLite and zlib, so it is
+# called from a thread to keep the event loop free.
+async def fetch_json(session, semaphore, url, params, timeout, retries=3):
+    cache = get_http_cache()
+    key = cache_key(url, params)
+    for attempt in range(retries + 1):
+        proxy = proxy_manager.get()
+        await rate_limiter.acquire_async(url, proxy)
+        try:
+            entry = await asyncio.to_thread(cache.lookup, key) if cache else None
+        except sqlite3.Error:
+            entry = None  # Sent without validators, a broken cache only costs bandwidth
+        try:
+            async with semaphore:
+                start = time.monotonic()
+                async with session.get(url, params=params, proxy=proxy, headers=HttpCache.validators(entry),
+                                       timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    proxy_manager.report(proxy, proxy_ok(response.status), time.monotonic() - start, response.status)
+                    rate_limiter.report(url, proxy, response.status, response.headers.get("Retry-After"))
+                    if response.status == 304 and entry:
+                        return json.loads(await asyncio.to_thread(cache.hit, key, entry))
+                    if not proxy_ok(response.status) and attempt < retries:
+                        # 429 and 5xx slowed the bucket down, the next acquire waits for it. 403 and
+                        # 407 blame the proxy, the next attempt takes another one.
+                        continue
+                    response.raise_for_status()
+                    body = await response.read()
+                    if cache:
+                        try:
+                            await asyncio.to_thread(cache.store, key, response.status, response.headers, body)
+                        except sqlite3.Error:
+                            pass
+                    return json.loads(body)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            proxy_manager.report(proxy, False)
+            if attempt == retries:  # Retry on failure with another proxy
+                raise
+
+async def fetch_steam_apps(session, semaphore):
     try:
-        response = session.get(STEAM_API_URL, timeout=15)
-        response.raise_for_status()
-        return response.json().get("applist", {}).get("apps", [])
-    except requests.RequestException as e:
+        if STEAM_API_KEY:
+            return await fetch_store_apps(session, semaphore)
+        data = await fetch_json(session, semaphore, STEAM_API_URL, None, 15)
+        return data.get("applist", {}).get("apps", [])
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         print(f"Failed to fetch app list : {e}")
         return []
 
-def fetch_game_details(app_id, session):
-    base_url = "https://store.steampowered.com/api/appdetails"
+# Paged app list of IStoreService, every app comes with its last_modified time
+async def fetch_store_apps(session, semaphore):
+    apps = []
+    last_appid = 0
+    while True:
+        params = {
+            "key": STEAM_API_KEY, "max_results": 50000, "last_appid": last_appid,
+            "include_games": "true", "include_dlc": "true", "include_software": "true",
+            "include_videos": "true", "include_hardware": "true",
+        }
+        data = await fetch_json(session, semaphore, STORE_APP_LIST_URL, params, 30)
+        response = data.get("response", {})
+        apps.extend(response.get("apps", []))
+        if not response.get("have_more_results"):
+            return apps
+        last_appid = response["last_appid"]
+
+# Per-appid fetch time and content hashes, persisted in a Mongo side collection
+class SteamIndex:
+    def __init__(self, db):
+        self.collection = db[INDEX_COLLECTION]
+        self.collection.create_index("appid", unique=True)
+        self.entries = {
+            doc["appid"]: doc
+            for doc in self.collection.find({}, {"_id": 0, "appid": 1, "fetched_at": 1, "last_modified": 1})
+        }
+        self.pending = []
+
+    # Returns (apps to fetch, apps kept as they are). New apps come first, then apps
+    # changed on Steam, then the known apps older than steam_refresh_hours, oldest first.
+    def plan(self, apps):
+        cutoff = time.time() - steam_refresh_hours * 3600
+        new, changed, due, fresh = [], [], [], []
+        for app in apps:
+            entry = self.entries.get(app["appid"])
+            if entry is None:
+                new.append(app)
+            elif app.get("last_modified", 0) > entry.get("last_modified", 0):
+                changed.append(app)
+            elif entry.get("fetched_at", 0) < cutoff:
+                due.append(app)
+            else:
+                fresh.append(app)
+
+        due.sort(key=lambda app: self.entries[app["appid"]].get("fetched_at", 0))
+        if steam_max_refresh and len(due) > steam_max_refresh:
+            fresh.extend(due[steam_max_refresh:])
+            due = due[:steam_max_refresh]
+        log_info(f"Steam delta : {len(new)} new, {len(changed)} changed, {len(due)} to refresh, {len(fresh)} up to date")
+        return new + changed + due, fresh
+
+    def record(self, app, game_data):
+        entry = {"appid": app["appid"], "fetched_at": time.time(), "available": "error" not in game_data}
+        if "last_modified" in app:
+            entry["last_modified"] = app["last_modified"]
+        if entry["available"]:
+            # price_values is parsed from prices by the writer, it changes with them
+            entry["detail_hash"] = content_hash({k: v for k, v in game_data.items() if k not in ("prices", "price_values")})
+            entry["price_hash"] = content_hash(game_data["prices"])
+        self.pending.append(UpdateOne(
+            {"appid": app["appid"]},
+            {"$set": entry, "$setOnInsert": {"first_seen": entry["fetched_at"]}},
+            upsert=True
+        ))
+        return len(self.pending) >= mongo_batch_size
+
+    def flush(self):
+        operations, self.pending = self.pending, []
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+
+async def fetch_game_details(app_id, session, semaphore):
     try:
-        response = session.get(base_url, params={"appids": app_id, "l": "en"}, timeout=15)
-        response.raise_for_status()
-        data = response.json()
+        data = await fetch_json(session, semaphore, APP_DETAILS_URL, {"appids": app_id, "l": "en"}, 15)
 
-        if str(app_id) not in data or not data[str(app_id)]["success"]:
+        # Steam answers null instead of a 429 when it throttles
+        if not isinstance(data, dict):
+            return {"error": f"Game {app_id} details: unexpected payload {str(data)[:50]}", "failed": True, "permanent": False}
+        entry = data.get(str(app_id))
+        if not isinstance(entry, dict) or not entry.get("success"):
             return {"error": f"Game {app_id} details not available"}
 
-        game_data = data[str(app_id)]["data"]
-        prices = {region: fetch_price_for_region(app_id, region) for region in regions_steam}
-
+        game_data = entry.get("data")
+        if not isinstance(game_data, dict):
+            return {"error": f"Game {app_id} details: unexpected data", "failed": True, "permanent": False}
         return {
+            "appid": app_id,
             "title": game_data.get("name", "N/A"),
             "categories": [c["description"] for c in game_data.get("categories", [])],
             "short_description": game_data.get("short_description", "N/A"),
@@ -53,59 +186,139 @@ def fetch_game_details(app_id, session):
             "publisher": ", ".join(game_data.get("publishers", [])),
             "platforms": ", ".join(k for k, v in game_data.get("platforms", {}).items() if v),
             "release_date": game_data.get("release_date", {}).get("date", "N/A"),
-            "prices": prices
+            "prices": {}
         }
-    except requests.RequestException as e:
-        return {"error": str(e)}
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        # Out of retries or not JSON, the app goes to the dead letters. A 404 will not change.
+        permanent = isinstance(e, aiohttp.ClientResponseError) and e.status in PERMANENT_STATUSES
+        return {"error": f"{type(e).__name__}: {e}", "failed": True, "permanent": permanent}
 
-def fetch_price_for_region(app_id, region):
-    base_url = "https://store.steampowered.com/api/appdetails"
-    proxy = next(proxy_pool)
-    session = create_session(proxy)
-    try:
-        response = session.get(base_url, params={"appids": app_id, "cc": region, "l": "en"}, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-
-        if str(app_id) in data and data[str(app_id)]["success"]:
-            price_info = data[str(app_id)]["data"].get("price_overview")
-            return price_info.get("final_formatted", "Free or Not Available") if price_info else "Not Available"
-    except requests.RequestException as e:
-        print(f"Error fetching price for {app_id} in {region}: {e}")
-    return "Not Available"
-
-def process_apps_range(start_index, end_index, apps, proxy):
-    session = create_session(proxy)
-    db = get_mongo_db()
+# Price of many apps in one region with a single request, filters=price_overview
+# makes Steam accept a list of appids and return only the price block. A failed request
+# or a payload that is not an object raises, the caller fails the priced apps rather than
+# saving them without prices.
+async def fetch_prices_for_region(app_ids, region, session, semaphore):
+    params = {"appids": ",".join(str(app_id) for app_id in app_ids), "cc": region, "l": "en", "filters": "price_overview"}
+    data = await fetch_json(session, semaphore, APP_DETAILS_URL, params, 10)
+    if not isinstance(data, dict):
+        raise ValueError(f"unexpected price payload {str(data)[:50]}")
+
+    prices = {}
+    for app_id in app_ids:
+        entry = data.get(str(app_id))
+        price_info = None
+        if isinstance(entry, dict) and entry.get("success"):
+            # Apps without a price come back with an empty list as data
+            price_info = entry["data"].get("price_overview") if isinstance(entry["data"], dict) else None
+        prices[app_id] = price_info.get("final_formatted", "Free or Not Available") if price_info else "Not Available"
+    return prices
 
-    for index in range(start_index, end_index):
-        app = apps[index]
+# Each worker takes a chunk of apps from the shared queue until it is empty. Details are
+# fetched per app, prices once per region for the whole chunk. Apps whose requests failed
+# are added to failures.
+async def process_apps(queue, session, semaphore, writer, index, failures):
+    while True:
+        chunk = []
+        while len(chunk) < price_batch_size and not queue.empty():
+            chunk.append(queue.get_nowait())
+        if not chunk:
+            return
         try:
-            game_data = fetch_game_details(app["appid"], session)
-            if "error" not in game_data:
-                save_to_mongo(db, "steam_games", game_data)
+            # An unexpected error of one app only fails that app
+            details = [
+                {"error": f"{type(result).__name__}: {result}", "failed": True, "permanent": False}
+                if isinstance(result, Exception) else result
+                for result in await asyncio.gather(
+                    *(fetch_game_details(app["appid"], session, semaphore) for app in chunk), return_exceptions=True
+                )
+            ]
+            available = [game_data["appid"] for game_data in details if "error" not in game_data]
+            if available:
+                try:
+                    region_prices = await asyncio.gather(
+                        *(fetch_prices_for_region(available, region, session, semaphore) for region in regions_steam)
+                    )
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    # Out of retries or a bad payload, the priced apps of the chunk go to the dead letters
+                    print(f"Error fetching prices for {len(available)} apps: {e}")
+                    for i, game_data in enumerate(details):
+                        if "error" not in game_data:
+                            details[i] = {"error": f"prices: {type(e).__name__}: {e}", "failed": True, "permanent": False}
+                else:
+                    for game_data in details:
+                        if "error" not in game_data:
+                            game_data["prices"] = {
+                                region: prices[game_data["appid"]] for region, prices in zip(regions_steam, region_prices)
+                            }
+
+            for app, game_data in zip(chunk, details):
+                if game_data.get("failed"):
+                    failures[app["appid"]] = failure_record(app, game_data["error"], game_data["permanent"], 1)
+                    continue  # Not recorded in the index, so the next run fetches it again
+                if "error" not in game_data:
+                    await asyncio.to_thread(writer.add, game_data)
+                if index.record(app, game_data):
+                    await asyncio.to_thread(index.flush)
         except Exception as e:
-            print(f"Error processing app {app['appid']}: {e}")
+            print(f"Error processing apps {chunk[0]['appid']}..{chunk[-1]['appid']}: {e}")
+            for app in chunk:
+                failures.setdefault(app["appid"], failure_record(app, f"{type(e).__name__}: {e}", False, 1))
 
-def main():
-    proxy_list = list(itertools.islice(proxy_pool, n_processes))  # Get unique proxies for each process
+# Fetches the apps with n_workers workers, returns {appid: failure} of the failed ones
+async def crawl(apps, session, semaphore, db, index, mode=None):
+    queue = asyncio.Queue()
+    for app in apps:
+        queue.put_nowait(app)
 
-    apps = fetch_steam_apps(create_session(proxy_list[0]))  # Initial fetch using a proxy
-    if not apps:
-        log_info("No Steam apps found to process.")
-        return
+    failures = {}
+    with MongoWriter(db, "steam_games", mode=mode) as writer:
+        await asyncio.gather(
+            *(process_apps(queue, session, semaphore, writer, index, failures) for _ in range(n_workers))
+        )
+    index.flush()
+    log_info(f"Steam : {len(apps) - len(failures)} apps done, {len(failures)} failed")
+    return failures
 
-    total_apps = len(apps)
-    log_info(f"Found {total_apps} games in Steam")
-    chunk_size = (total_apps + n_processes - 1) // n_processes
-    ranges = [(i * chunk_size, min((i + 1) * chunk_size, total_apps)) for i in range(n_processes)]
+async def run(run_started):
+    semaphore = asyncio.Semaphore(max_concurrency)
+    cache_before = http_cache_stats()
 
-    # Use Pool to manage processes efficiently with proxies
-    with multiprocessing.Pool(processes=n_processes) as pool:
-        pool.starmap(process_apps_range, [(start, end, apps, proxy_list[i]) for i, (start, end) in enumerate(ranges)])
+    async with create_session() as session:
+        apps = await fetch_steam_apps(session, semaphore)
+        if not apps:
+            log_info("No Steam apps found to process.")
+            return False
+
+        log_info(f"Found {len(apps)} games in Steam")
+        db = get_mongo_db()
+        index = SteamIndex(db)
+        if write_mode == "incremental":
+            apps, fresh = index.plan(apps)
+            mark_seen(db, "steam_games", [app["appid"] for app in fresh])
+        failures = await crawl(apps, session, semaphore, db, index)
+    write_dead_letters(db, "steam_games", failures, run_started)
+    mark_failures_seen(db, "steam_games", failures)
+    log_proxy_stats("Steam", proxy_manager)
+    log_http_cache_stats("Steam", cache_before)
+    return True
+
+async def replay_apps(apps):
+    async with create_session() as session:
+        db = get_mongo_db()
+        return await crawl(apps, session, asyncio.Semaphore(max_concurrency), db, SteamIndex(db), "incremental")
+
+# Fetches dead-letter entries again and upserts them into the live collection. Returns the
+# failures of the apps that failed again.
+def replay(entries):
+    return asyncio.run(replay_apps([app for _, app in entries]))
+
+def main():
+    run_started = datetime.now(timezone.utc)
+    if not asyncio.run(run(run_started)):
+        return
 
     db = get_mongo_db()
-    update_mongo(db, "steam_games")
+    update_mongo(db, "steam_games", run_started)
     log_info("All Steam processes completed.")
 
 if __name__ == "__main__":
@@ -1,14 +1,24 @@
 from bs4 import BeautifulSoup
+from parsers import SelectorSet, XBOX_PRICE_FIELDS, XBOX_PRICE_MARKER
 from utils import (
-    get_mongo_db, save_to_mongo, update_mongo, get_selenium_browser, log_info,
-    click_loadmore_btn, regions_xbox
+    get_mongo_db, MongoWriter, update_mongo, get_selenium_browser, BrowserPool, log_info,
+    click_loadmore_btn, get_pooled_session, rate_limited_request, rate_limited_browse, start_work_manager, fill_work_queue, log_work_stats,
+    http_cache_stats, log_http_cache_stats, is_permanent, write_dead_letters, mark_failures_seen, backoff_delay, regions_xbox,
+    work_max_attempts, write_mode
 )
+import os
+import re
+import time
 import multiprocessing
 import requests
-from requests.adapters import HTTPAdapter
+from datetime import datetime, timezone
 
 n_processes = 20
 XBOX_URL = "https://www.xbox.com/en-US/games/browse"
+XBOX_BROWSE_API = "https://emerald.xboxservices.com/xboxcomfd/browse?locale=en-US"  # JSON the browse page loads
+XBOX_STORE_URL = "https://www.xbox.com/en-US/games/store"
+BROWSE_CHANNEL = "BROWSE_CHANNELID=_FILTERS="
+xbox_listing = os.getenv("xbox_listing", "api")  # "api" walks the browse JSON, "browser" clicks "Load more"
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:110.0) Gecko/20100101 Firefox/110.0",
@@ -17,12 +27,71 @@ HEADERS = {
     "Connection": "keep-alive",
 }
 
+BROWSE_HEADERS = {
+    "Content-Type": "application/json",
+    "Origin": "https://www.xbox.com",
+    "x-ms-api-version": "1.1",
+}
+
+PRICE_SELECTORS = SelectorSet(XBOX_PRICE_FIELDS)
+
 def create_session():
-    session = requests.Session()
-    session.headers.update(HEADERS)
-    session.mount('https://', HTTPAdapter(max_retries=3))
-    return session
+    return get_pooled_session(headers=HEADERS)
+
+# Same link the product card points to, the store resolves it by the product id at the end
+def store_link(product):
+    slug = re.sub(r'[^a-z0-9]+', '-', product.get("title", "").lower()).strip('-') or "game"
+    return f"{XBOX_STORE_URL}/{slug}/{product['productId']}"
+
+# One page of the browse API as (detail links, continuation token of the next page)
+def parse_browse_page(payload):
+    links = [store_link(product) for product in payload.get("productSummaries", []) if product.get("productId")]
+    channel = payload.get("channels", {}).get(BROWSE_CHANNEL, {})
+    return links, channel.get("encodedCT")
+
+# One page of the browse API, tried work_max_attempts times with backoff like the other
+# listings. Raises once the attempts are used up.
+def fetch_browse_page(session, token, limiter=None):
+    body = {
+        "Filters": "e30=",  # Base64 of "{}", no filter
+        "ReturnFilters": False,
+        "ChannelKeyToBeUsedInResponse": BROWSE_CHANNEL,
+        "EncodedCT": token,
+        "ChannelId": "",
+    }
+    for attempt in range(work_max_attempts):
+        try:
+            response = rate_limited_request(session, "POST", XBOX_BROWSE_API, limiter, json=body, headers=BROWSE_HEADERS, timeout=30)
+            response.raise_for_status()
+            return parse_browse_page(response.json())
+        except (requests.RequestException, ValueError) as e:
+            if is_permanent(e) or attempt == work_max_attempts - 1:
+                raise
+            print(f"Error fetching Xbox browse page, retrying: {e}")
+            time.sleep(backoff_delay(attempt, base=10))
+
+# Walks the paginated browse API and yields the detail links page by page
+def iter_xbox_games(session, limiter=None):
+    token = None
+    while True:
+        links, token = fetch_browse_page(session, token, limiter)
+        yield links
+        if not links or not token:
+            return
+
+# Puts the games into the queue as the pages arrive, workers start on them right away.
+# Returns (games queued, whether the listing reached its last page).
+def queue_xbox_games(queue, limiter=None):
+    total_games = 0
+    try:
+        for links in iter_xbox_games(create_session(), limiter):
+            total_games += queue.put_many([(link, link) for link in links])
+    except (requests.RequestException, ValueError) as e:
+        print(f"Error fetching Xbox game list: {e}")
+        return total_games, False
+    return total_games, True
 
+# Returns the detail links only, so the big listing soup is freed before workers start
 def fetch_xbox_games():
     try:
         browser = get_selenium_browser()
@@ -30,7 +99,10 @@ def fetch_xbox_games():
         browser = click_loadmore_btn(browser, '//button[contains(@aria-label, "Load more")]')
         soup = BeautifulSoup(browser.page_source, "html.parser")
         browser.quit()
-        return soup.find_all('div', class_='ProductCard-module__cardWrapper___6Ls86 shadow')
+        cards = soup.find_all('div', class_='ProductCard-module__cardWrapper___6Ls86 shadow')
+        links = [card.find('a', href=True)['href'] for card in cards if card.find('a', href=True)]
+        soup.decompose()
+        return links
     except Exception as e:
         print(f"Error fetching Xbox game list: {e}")
         browser.quit()
@@ -42,92 +114,140 @@ def safe_find(soup, tag, css_class=None, attr=None):
         return element[attr] if element else None
     return element.text.strip() if element else "N/A"
 
-def fetch_price_for_region(details_link, region):
+def fetch_price_for_region(details_link, region, limiter=None):
     try:
         region_url = details_link.replace("en-US", region)
         session = create_session()
-        response = session.get(region_url, timeout=10)
+        response = rate_limited_request(session, "GET", region_url, limiter, timeout=10)
         response.raise_for_status()
-        price_soup = BeautifulSoup(response.content, 'html.parser')
-        price_element = safe_find(price_soup, 'span', "Price-module__boldText___1i2Li")
+        price_element = PRICE_SELECTORS.extract_fragment(response.content, "price", XBOX_PRICE_MARKER)
         return price_element or "BUNDLE NOT AVAILABLE"
     except requests.RequestException as e:
         return "BUNDLE NOT AVAILABLE"
 
-def process_xbox_game(game):
-    try:
-        browser = get_selenium_browser()
-        details_link = game.find('a', href=True)['href']
-        browser.get(details_link)
-        details_soup = BeautifulSoup(browser.page_source, 'html.parser')
+# The store key of a game, the product id the detail link ends with
+def product_id(details_link):
+    return details_link.rstrip('/').split('/')[-1]
 
-        title = safe_find(details_soup, 'h1', "typography-module__xdsH1___7oFBA") or "No Title"
-        category_rating_text = safe_find(details_soup, 'span', "ProductInfoLine-module__textInfo___jOZ96")
-        categories = category_rating_text.split("•") if category_rating_text else []
-        rating = categories.pop() if categories and categories[-1].endswith('K') else "Not Rated"
-        short_description = safe_find(details_soup, 'meta', attr='content') or "No Description"
-        full_description = safe_find(details_soup, 'p', "Description-module__description___ylcn4") or "No Description"
-        screenshots = [img['src'] for img in details_soup.select('section[aria-label="Gallery"] img')] or []
-        header_image = safe_find(details_soup, 'img', "ProductDetailsHeader-module__productImage___QK3JA", 'src') or "No Image"
-        publisher = safe_find(details_soup, 'div', "typography-module__xdsBody2___RNdGY") or "No Publisher"
-        platforms = [item.text.strip() for item in details_soup.select('ul.FeaturesList-module__wrapper___KIw42 li')] or ["No Platforms"]
-        release_date = safe_find(details_soup, 'div', "typography-module__xdsBody2___RNdGY") or "No Release Date"
-
-        prices = {"us": safe_find(details_soup, 'span', "Price-module__boldText___1i2Li") or "BUNDLE NOT AVAILABLE"}
-        prices.update({region.split('-')[1]: fetch_price_for_region(details_link, region) for region in regions_xbox})
-        browser.quit()
-        return {
-            "title": title,
-            "categories": categories,
-            "short_description": short_description,
-            "full_description": full_description,
-            "screenshots": screenshots,
-            "header_image": header_image,
-            "rating": rating,
-            "publisher": publisher,
-            "platforms": platforms,
-            "release_date": release_date,
-            "prices": prices,
-        }
-    except Exception as e:
-        print(f"Error processing game details: {e}")
-        browser.quit()
-        return None
-
-def process_games_range(start_index, end_index, games):
-    db = get_mongo_db()
+# Errors are left to the worker, which retries or dead-letters the game
+def process_xbox_game(details_link, browser_pool, limiter=None):
+    with browser_pool.browser() as browser:
+        rate_limited_browse(browser, details_link, limiter)
+        details_soup = BeautifulSoup(browser.page_source, 'html.parser')
 
-    for index in range(start_index, end_index):
-        try:
-            game_data = process_xbox_game(games[index])
-            if game_data:
-                save_to_mongo(db, "xbox_games", game_data)
-        except Exception as e:
-            print(f"Error processing Xbox game at index {index}: {e}")
+    title = safe_find(details_soup, 'h1', "typography-module__xdsH1___7oFBA") or "No Title"
+    category_rating_text = safe_find(details_soup, 'span', "ProductInfoLine-module__textInfo___jOZ96")
+    categories = category_rating_text.split("•") if category_rating_text else []
+    rating = categories.pop() if categories and categories[-1].endswith('K') else "Not Rated"
+    short_description = safe_find(details_soup, 'meta', attr='content') or "No Description"
+    full_description = safe_find(details_soup, 'p', "Description-module__description___ylcn4") or "No Description"
+    screenshots = [img['src'] for img in details_soup.select('section[aria-label="Gallery"] img')] or []
+    header_image = safe_find(details_soup, 'img', "ProductDetailsHeader-module__productImage___QK3JA", 'src') or "No Image"
+    publisher = safe_find(details_soup, 'div', "typography-module__xdsBody2___RNdGY") or "No Publisher"
+    platforms = [item.text.strip() for item in details_soup.select('ul.FeaturesList-module__wrapper___KIw42 li')] or ["No Platforms"]
+    release_date = safe_find(details_soup, 'div', "typography-module__xdsBody2___RNdGY") or "No Release Date"
+
+    prices = {"us": safe_find(details_soup, 'span', "Price-module__boldText___1i2Li") or "BUNDLE NOT AVAILABLE"}
+    prices.update({region.split('-')[1]: fetch_price_for_region(details_link, region, limiter) for region in regions_xbox})
+    return {
+        "product_id": product_id(details_link),
+        "title": title,
+        "categories": categories,
+        "short_description": short_description,
+        "full_description": full_description,
+        "screenshots": screenshots,
+        "header_image": header_image,
+        "rating": rating,
+        "publisher": publisher,
+        "platforms": platforms,
+        "release_date": release_date,
+        "prices": prices,
+    }
+
+# Each worker leases games from the shared queue until it is empty. All workers share
+# the rate limiter, so the request rate to www.xbox.com is counted once for the run.
+def process_games_queue(queue, limiter, mode=None):
+    with MongoWriter(get_mongo_db(), "xbox_games", mode=mode) as writer, BrowserPool() as browser_pool:
+        while True:
+            lease = queue.lease()
+            if lease is None:
+                break
+            details_link, _ = lease
+            try:
+                writer.add(process_xbox_game(details_link, browser_pool, limiter))
+                queue.ack(details_link)
+            except Exception as e:
+                print(f"Error processing Xbox game {details_link}: {e}")
+                queue.fail(details_link, f"{type(e).__name__}: {e}", is_permanent(e))
+
+# Runs the workers on dead-letter entries and upserts the games into the live collection.
+# Returns the failures of the items that failed again.
+def replay(entries):
+    manager = start_work_manager()
+    queue = manager.WorkQueue()
+    limiter = manager.RateLimiter()
+    queue.put_many(entries)
+    queue.close()
+    processes = [
+        multiprocessing.Process(target=process_games_queue, args=(queue, limiter, "incremental"))
+        for _ in range(min(n_processes, len(entries)))
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failures = queue.failures()
+    log_work_stats("Xbox replay", queue)
+    manager.shutdown()
+    return failures
 
 def main():
+    run_started = datetime.now(timezone.utc)
     log_info("Waiting for fetching Xbox games...")
-    games = fetch_xbox_games()
-
-    total_games = len(games)
-    if total_games == 0:
-        log_info("No games found to process.")
-        return
-
-    chunk_size = (total_games + n_processes - 1) // n_processes
-    ranges = [(i * chunk_size, min((i + 1) * chunk_size, total_games)) for i in range(n_processes)]
+    cache_before = http_cache_stats()
+    manager = start_work_manager()
+    queue = manager.WorkQueue()
+    limiter = manager.RateLimiter()
 
     processes = []
-    for start, end in ranges:
-        process = multiprocessing.Process(target=process_games_range, args=(start, end, games))
+    for _ in range(n_processes):
+        process = multiprocessing.Process(target=process_games_queue, args=(queue, limiter))
         processes.append(process)
         process.start()
 
+    if xbox_listing == "api":
+        total_games, complete = queue_xbox_games(queue, limiter)
+    else:
+        games = fetch_xbox_games()
+        total_games, complete = fill_work_queue(queue, [(link, link) for link in games]), True
+        del games  # Workers read their links from the queue
+    queue.close()
+    log_info(f"Fetched {total_games} games in Xbox.")
+
     for process in processes:
         process.join()
-
+    log_work_stats("Xbox", queue)
+    log_http_cache_stats("Xbox", cache_before)
     db = get_mongo_db()
-    update_mongo(db, "xbox_games")
+    failures = queue.failures()
+    write_dead_letters(db, "xbox_games", failures, run_started)
+    mark_failures_seen(db, "xbox_games", failures, product_id)
+    manager.shutdown()
+
+    if total_games == 0:
+        log_info("No games found to process.")
+        return
+
+    if not complete:
+        # Games past the failed page were not listed, they are neither gone nor stale
+        if write_mode != "incremental":
+            log_info("Xbox listing incomplete, the live collection is kept.")
+            db["xbox_games_tmp"].drop()
+            return
+        log_info("Xbox listing incomplete, no games are marked as stale.")
+        run_started = None
+
+    update_mongo(db, "xbox_games", run_started)
     log_info("All Xbox processes completed.")
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+import sqlite3
+import pytest
+import requests
+from requests.adapters import HTTPAdapter
+import http_cache
+from http_cache import CachingAdapter, HttpCache
+
+URL = "https://example.com/game"
+
+def make_response(request, status, body=b"", headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    response._content = body
+    response.request = request
+    response.url = request.url
+    return response
+
+# Stands in for the network: answers 304 when the request carries the etag
+@pytest.fixture
+def sent(monkeypatch):
+    requests_sent = []
+
+    def send(adapter, request, **kwargs):
+        requests_sent.append(dict(request.headers))
+        if request.headers.get("If-None-Match") == '"v1"':
+            return make_response(request, 304)
+        return make_response(request, 200, b"page", {"ETag": '"v1"'})
+
+    monkeypatch.setattr(HTTPAdapter, "send", send)
+    return requests_sent
+
+def get(url=URL):
+    session = requests.Session()
+    session.mount("https://", CachingAdapter())
+    return session.get(url)
+
+def test_caching_adapter_answers_304_from_cache(tmp_path, monkeypatch, sent):
+    cache = HttpCache(str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(http_cache, "get_http_cache", lambda: cache)
+
+    first, second = get(), get()
+    assert (first.content, first.from_cache) == (b"page", False)
+    assert (second.status_code, second.content, second.from_cache) == (200, b"page", True)
+    assert sent[1]["If-None-Match"] == '"v1"'
+
+class LockedCache(HttpCache):
+    def __init__(self, fail):
+        self.fail = fail
+
+    def lookup(self, url):
+        if "lookup" in self.fail:
+            raise sqlite3.OperationalError("database is locked")
+        return None
+
+    def store(self, url, status, headers, body):
+        if "store" in self.fail:
+            raise sqlite3.OperationalError("database is locked")
+
+@pytest.mark.parametrize("fail", [("lookup",), ("store",), ("lookup", "store")])
+def test_caching_adapter_sends_without_a_locked_cache(monkeypatch, sent, fail):
+    monkeypatch.setattr(http_cache, "get_http_cache", lambda: LockedCache(fail))
+    response = get()
+    assert (response.status_code, response.content) == (200, b"page")
+    assert "If-None-Match" not in sent[0]
+
+class LockedConnection:
+    def execute(self, *args):
+        raise sqlite3.OperationalError("database is locked")
+
+def test_hit_returns_body_when_bookkeeping_fails(tmp_path):
+    cache = HttpCache(str(tmp_path / "cache.sqlite"))
+    cache.store(URL, 200, {"ETag": '"v1"'}, b"page")
+    entry = cache.lookup(URL)
+    connection, cache.connection = cache.connection, LockedConnection()
+    try:
+        assert cache.hit(URL, entry) == b"page"
+    finally:
+        cache.connection = connection
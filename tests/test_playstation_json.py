@@ -0,0 +1,68 @@
+import json
+import os
+import pytest
+from parsers import SelectorSet, PLAYSTATION_GAME_FIELDS, extract_playstation_json, find_apollo_state
+
+# Also the pages bench_parsers runs on
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+CONCEPT_PAGES = ["playstation_concept_10000176.html", "playstation_concept_10002694.html"]
+
+def load_page(name):
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        return f.read()
+
+def page_with(next_data):
+    return f'<html><body><script id="__NEXT_DATA__" type="application/json">{json.dumps(next_data)}</script></body></html>'
+
+def test_extract_playstation_json_concept_page():
+    game = extract_playstation_json(load_page("playstation_concept_10002694.html"))
+    assert game == {
+        "title": "Ghost of Tsushima",
+        "short_description": "In the late 13th century, the Mongol empire has laid waste to entire nations.",
+        "full_description": "Forge a new path and wage an unconventional war for the freedom of Tsushima.",
+        "header_image": "https://image.api.playstation.com/vulcan/ap/rnd/202106/2322/c16gs6a7lbAYzPf7ZTikbH1c.png",
+        "rating": "4.85",
+        "publisher": "Sony Interactive Entertainment",
+        "platforms": "PS5, PS4",
+        "release_date": "2021-08-20T00:00:00Z",
+        "categories": ["Action", "Adventure"],
+    }
+
+# The JSON path must give the fields the DOM selectors would, so either can fill a game
+@pytest.mark.parametrize("name", CONCEPT_PAGES)
+def test_extract_playstation_json_matches_dom(name):
+    page = load_page(name)
+    from_json = extract_playstation_json(page)
+    from_dom = SelectorSet(PLAYSTATION_GAME_FIELDS, backend="bs4").extract(page)
+    assert set(from_json) == set(PLAYSTATION_GAME_FIELDS)
+    for field in ("title", "full_description", "rating", "publisher", "platforms", "categories"):
+        assert from_json[field] == from_dom[field]
+
+def test_extract_playstation_json_accepts_text():
+    page = load_page(CONCEPT_PAGES[0])
+    assert extract_playstation_json(page.decode("utf-8")) == extract_playstation_json(page)
+
+def test_extract_playstation_json_without_blob():
+    assert extract_playstation_json(load_page("playstation_price_en-us.html")) is None
+
+def test_extract_playstation_json_broken_blob():
+    assert extract_playstation_json(b'<script id="__NEXT_DATA__" type="application/json">{"props": </script>') is None
+    assert extract_playstation_json(b'<script id="__NEXT_DATA__" type="application/json">{}') is None
+
+def test_extract_playstation_json_without_concept_name():
+    state = {"Concept:1": {"__typename": "Concept", "id": "1"}, "Product:A": {"name": "Product only"}}
+    assert extract_playstation_json(page_with({"props": {"pageProps": {"apolloState": state}}})) is None
+
+def test_extract_playstation_json_defaults():
+    state = {"Concept:1": {"name": "Bare"}}
+    game = extract_playstation_json(page_with({"props": {"apolloState": state}}))
+    assert game == {
+        "title": "Bare", "short_description": "N/A", "full_description": "N/A", "header_image": "N/A",
+        "rating": "N/A", "publisher": "N/A", "platforms": "N/A", "release_date": "N/A", "categories": [],
+    }
+
+def test_find_apollo_state_locations():
+    state = {"Concept:1": {"name": "A"}}
+    assert find_apollo_state(page_with({"props": {"apolloState": state}})) == state
+    assert find_apollo_state(page_with({"props": {"pageProps": {"apolloState": state}}})) == state
+    assert find_apollo_state("<html></html>") is None
@@ -0,0 +1,55 @@
+import os
+import uuid
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from utils import STORE_KEYS, ensure_indexes, check_query_plans, plan_stages
+
+# The explain checks need a MongoDB server, MONGO_URI as for the scrapers
+mongo_uri = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
+
+class ExplainedCollection:
+    def __init__(self, plan):
+        self.plan = plan
+
+    def find(self, query):
+        return self
+
+    def explain(self):
+        return {"queryPlanner": {"winningPlan": self.plan}}
+
+def test_plan_stages_classic_engine():
+    plan = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "title_1"}}
+    assert plan_stages(ExplainedCollection(plan), {"title": ""}) == ["FETCH", "IXSCAN"]
+
+def test_plan_stages_slot_based_engine():
+    plan = {"queryPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}, "slotBasedPlan": {"stages": "..."}}
+    assert plan_stages(ExplainedCollection(plan), {"title": ""}) == ["FETCH", "IXSCAN"]
+
+@pytest.fixture
+def games():
+    client = MongoClient(mongo_uri, serverSelectionTimeoutMS=2000)
+    try:
+        client.admin.command("ping")
+    except PyMongoError:
+        pytest.skip(f"no MongoDB server at {mongo_uri}")
+    collection = client["test"][f"query_plans_{uuid.uuid4().hex}"]
+    collection.insert_many([
+        {"appid": appid, "title": f"Game {appid}",
+         "prices": {"us": f"${appid}.99", "gb": "Free or Not Available"} if appid % 3 else {"us": "Free or Not Available"}}
+        for appid in range(1, 301)
+    ])
+    yield collection
+    collection.drop()
+    client.close()
+
+# Every query the API runs on a game collection must be answered from an index
+def test_api_queries_use_indexes(games):
+    key_field = STORE_KEYS["steam_games"]
+    ensure_indexes(games, key_field)
+    plans = check_query_plans(games, key_field)
+
+    assert set(plans) == {"title", key_field, "prices.gb"}
+    for name, stages in plans.items():
+        assert "IXSCAN" in stages, name
+        assert "COLLSCAN" not in stages, name
@@ -0,0 +1,125 @@
+import json
+import os
+import pytest
+import requests
+import scraper_xbox
+from scraper_xbox import BROWSE_CHANNEL, XBOX_BROWSE_API, parse_browse_page, iter_xbox_games, queue_xbox_games
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding="utf-8") as f:
+        return json.load(f)
+
+class FakeResponse:
+    def __init__(self, payload, status_code=200):
+        self.payload = payload
+        self.status_code = status_code
+        self.headers = {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"HTTP {self.status_code}", response=self)
+
+    def json(self):
+        return self.payload
+
+# Answers the browse POSTs with saved pages in order and keeps the request bodies.
+# An int in pages is answered with that status instead.
+class FakeSession:
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs.get("json")))
+        page = self.pages.pop(0)
+        return FakeResponse({}, status_code=page) if isinstance(page, int) else FakeResponse(page)
+
+class FakeQueue:
+    def __init__(self):
+        self.keys = []
+
+    def put_many(self, entries):
+        self.keys += [key for key, _ in entries]
+        return len(entries)
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(scraper_xbox.time, "sleep", lambda seconds: None)
+
+class NoWaitLimiter:
+    def reserve(self, url, proxy=None):
+        return 0
+
+    def report(self, url, proxy, status, retry_after=None):
+        pass
+
+def test_parse_browse_page_links():
+    links, _ = parse_browse_page(load_fixture("xbox_browse_page.json"))
+    assert links == [
+        "https://www.xbox.com/en-US/games/store/forza-horizon-5/9NBLGGH4R315",
+        "https://www.xbox.com/en-US/games/store/hades/9PP5G1F0C2B6",
+        "https://www.xbox.com/en-US/games/store/tom-clancy-s-rainbow-six-siege/C3KLDKZBHNCZ",
+    ]
+
+def test_parse_browse_page_continuation_token():
+    payload = load_fixture("xbox_browse_page.json")
+    _, token = parse_browse_page(payload)
+    assert token == payload["channels"][BROWSE_CHANNEL]["encodedCT"]
+
+def test_parse_browse_page_last_page():
+    links, token = parse_browse_page(load_fixture("xbox_browse_last.json"))
+    assert len(links) == 2
+    assert token is None
+
+def test_parse_browse_page_empty_payload():
+    assert parse_browse_page({}) == ([], None)
+
+def test_iter_xbox_games_follows_token_until_last_page():
+    first, last = load_fixture("xbox_browse_page.json"), load_fixture("xbox_browse_last.json")
+    session = FakeSession([first, last])
+    pages = list(iter_xbox_games(session, NoWaitLimiter()))
+
+    assert [len(links) for links in pages] == [3, 2]
+    assert [(method, url) for method, url, _ in session.requests] == [("POST", XBOX_BROWSE_API)] * 2
+    assert session.requests[0][2]["EncodedCT"] is None
+    assert session.requests[1][2]["EncodedCT"] == first["channels"][BROWSE_CHANNEL]["encodedCT"]
+
+def test_iter_xbox_games_stops_on_empty_page():
+    session = FakeSession([{"productSummaries": [], "channels": {BROWSE_CHANNEL: {"encodedCT": "more"}}}])
+    assert list(iter_xbox_games(session, NoWaitLimiter())) == [[]]
+    assert len(session.requests) == 1
+
+def test_iter_xbox_games_retries_a_failed_page():
+    first, last = load_fixture("xbox_browse_page.json"), load_fixture("xbox_browse_last.json")
+    session = FakeSession([first, 429, 503, last])
+    pages = list(iter_xbox_games(session, NoWaitLimiter()))
+
+    assert [len(links) for links in pages] == [3, 2]
+    token = first["channels"][BROWSE_CHANNEL]["encodedCT"]
+    assert [body["EncodedCT"] for _, _, body in session.requests] == [None, token, token, token]
+
+def test_iter_xbox_games_raises_when_out_of_attempts():
+    session = FakeSession([503] * scraper_xbox.work_max_attempts)
+    with pytest.raises(requests.HTTPError):
+        next(iter_xbox_games(session, NoWaitLimiter()))
+    assert len(session.requests) == scraper_xbox.work_max_attempts
+
+def test_iter_xbox_games_does_not_retry_permanent_errors():
+    session = FakeSession([404])
+    with pytest.raises(requests.HTTPError):
+        next(iter_xbox_games(session, NoWaitLimiter()))
+    assert len(session.requests) == 1
+
+def test_queue_xbox_games_reports_complete_listing(monkeypatch):
+    pages = [load_fixture("xbox_browse_page.json"), load_fixture("xbox_browse_last.json")]
+    monkeypatch.setattr(scraper_xbox, "create_session", lambda: FakeSession(pages))
+    queue = FakeQueue()
+    assert queue_xbox_games(queue, NoWaitLimiter()) == (5, True)
+    assert len(queue.keys) == 5
+
+def test_queue_xbox_games_reports_incomplete_listing(monkeypatch):
+    pages = [load_fixture("xbox_browse_page.json")] + [503] * scraper_xbox.work_max_attempts
+    monkeypatch.setattr(scraper_xbox, "create_session", lambda: FakeSession(pages))
+    assert queue_xbox_games(FakeQueue(), NoWaitLimiter()) == (3, False)
@@ -1,15 +1,32 @@
 import os
+import json
+import atexit
+import hashlib
 import logging
 import time
+import random
+import asyncio
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from multiprocessing.managers import BaseManager
+import threading
+import collections
+import psutil
+import requests
+from http_cache import CachingAdapter, get_http_cache, STAT_NAMES
+from price_parser import parse_prices, load_fx_rates, convert, PRICED, FREE
 from bs4 import BeautifulSoup
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
 from dotenv import load_dotenv
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.keys import Keys
 
@@ -18,6 +35,57 @@ load_dotenv()
 chromedriver_path = os.getenv("chromedriver_path")
 chrome_path = os.getenv("chrome_path")
 
+# HTTP connection pool limits
+http_pool_connections = int(os.getenv("http_pool_connections", 10))  # Hosts kept per session
+http_pool_maxsize = int(os.getenv("http_pool_maxsize", 10))  # Connections kept per host
+http_keepalive = int(os.getenv("http_keepalive", 60))  # Seconds an idle session stays open
+http_max_sessions = int(os.getenv("http_max_sessions", 256))  # Sessions kept per process
+
+# Mongo write buffer limits
+mongo_batch_size = int(os.getenv("mongo_batch_size", 500))  # Documents per insert_many
+mongo_batch_age = float(os.getenv("mongo_batch_age", 10))  # Seconds before a partial batch is flushed
+
+# Proxy health
+proxy_file = os.getenv("proxy_file", "proxies.txt")
+proxy_slice = os.getenv("proxy_slice")  # "start:end" fractions of the proxy list a run uses, set by the scheduler
+proxy_max_failures = int(os.getenv("proxy_max_failures", 3))  # Failures in a row before a proxy is quarantined
+proxy_quarantine_seconds = float(os.getenv("proxy_quarantine_seconds", 300))  # First cooldown, doubles on each quarantine
+
+# Request rate per (host, proxy), adapted AIMD-style from 429 responses
+rate_initial = float(os.getenv("rate_initial", 2))  # Requests per second a new host/proxy pair starts with
+rate_max = float(os.getenv("rate_max", 10))
+rate_min = float(os.getenv("rate_min", 0.05))
+rate_increase = float(os.getenv("rate_increase", 0.1))  # Added to the rate after each success
+rate_decrease = float(os.getenv("rate_decrease", 0.5))  # Rate multiplier after a 429
+
+# Selenium browser pool limits
+browser_max_pages = int(os.getenv("browser_max_pages", 100))  # Pages a driver serves before it is recycled
+browser_max_rss_mb = int(os.getenv("browser_max_rss_mb", 1500))  # Memory of chromedriver + Chrome before recycling
+
+# Work queue leases
+work_lease_seconds = float(os.getenv("work_lease_seconds", 900))  # Time a worker has for one item
+work_max_attempts = int(os.getenv("work_max_attempts", 3))  # Leases of an item before it is given up
+
+# "rebuild" writes into <collection>_tmp and swaps it in, "incremental" upserts into the live collection
+write_mode = os.getenv("write_mode", "rebuild")
+mongo_max_price_indexes = int(os.getenv("mongo_max_price_indexes", 50))  # MongoDB allows 64 indexes per collection
+fx_rates_path = os.getenv("fx_rates_path", "fx_rates.json")  # FX table of the cheapest-price views
+
+# Stable key of a game in each store, used by the incremental mode
+STORE_KEYS = {
+    "steam_games": "appid",
+    "playstation_games": "concept_id",
+    "xbox_games": "product_id",
+    "nintendo_games": "slug",
+}
+# Bookkeeping fields that are not part of the scraped content
+META_FIELDS = ("_id", "content_hash", "last_seen", "stale", "stale_since")
+
+# Items that failed for good, by store, with the reason. replay_dead_letters.py runs them again.
+DEAD_LETTER_COLLECTION = "dead_letters"
+GENERATION_COLLECTION = "collection_generations"  # Bumped when a collection changes, read by the API cache
+PERMANENT_STATUSES = (400, 404, 410)  # HTTP statuses a retry will not change
+
 regions_playstation = [
     # 'en-us',
     'en-eu',
@@ -119,24 +187,774 @@ def get_mongo_db():
     db = client["test"]
     return db
 
-def update_mongo(db, collection_name):
-    db[collection_name].drop()
-    db[f"{collection_name}_tmp"].rename(collection_name)
-
-def save_to_mongo(db, collection_name, data):
-    collection = db[f"{collection_name}_tmp"]
-    collection.insert_one(data)
-    # title = data.get("title")
-    # if title:
-    #     collection = db[collection_name]
-    #     existing_data = collection.find_one({"title" : title})
-    #     if existing_data:
-    #         collection.update_one(
-    #             {"_id": existing_data["_id"]},
-    #             {"$set": data}
-    #         )
-    #     else:
-    #         collection.insert_one(data)
+# Unique index on the store key, the one MongoWriter upserts by in incremental mode. Games
+# without the key are left out of it. An index on the same key made by an older version with
+# other options (a plain key index) is dropped and built again.
+def ensure_key_index(collection, key_field):
+    options = {"name": f"{key_field}_1", "unique": True, "partialFilterExpression": {key_field: {"$exists": True}}}
+    try:
+        collection.create_index(key_field, **options)
+    except OperationFailure as e:
+        if e.code not in (85, 86):  # IndexOptionsConflict, IndexKeySpecsConflict
+            raise
+        collection.drop_index(options["name"])
+        collection.create_index(key_field, **options)
+
+# A rebuild inserts without upserting, so a game listed twice by a store is in _tmp twice.
+# Only the last copy is kept, the unique key index could not be built otherwise.
+def drop_duplicate_keys(collection, key_field):
+    duplicates = collection.aggregate([
+        {"$match": {key_field: {"$exists": True}}},
+        {"$sort": {"_id": 1}},  # Inserted order, the last copy is the newest
+        {"$group": {"_id": f"${key_field}", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ], allowDiskUse=True)
+    removed = 0
+    for group in duplicates:
+        removed += collection.delete_many({"_id": {"$in": group["ids"][:-1]}}).deleted_count
+    if removed:
+        log_info(f"{collection.name} : {removed} duplicate games removed")
+
+# Indexes every game collection has when it goes live: the store key, the title and each
+# region price the API filters on. The filter {"prices.<region>": {"$ne": ...}} also matches
+# games without that region, which a wildcard index on prices cannot answer, so every region
+# gets its own index. The regions are read from a sample of the games.
+# price_values.<region>.amount_minor is indexed with _id for min_price/max_price and for
+# sort=price with a cursor. Both kinds share mongo_max_price_indexes.
+def ensure_indexes(collection, key_field):
+    ensure_key_index(collection, key_field)
+    collection.create_index("title")
+    collection.create_index("stale", partialFilterExpression={"stale": True})  # Only the few stale games
+    for region in price_regions(collection)[:mongo_max_price_indexes // 2]:
+        collection.create_index(f"prices.{region}")
+        collection.create_index([(f"price_values.{region}.amount_minor", 1), ("_id", 1)])
+
+def price_regions(collection, sample_size=1000):
+    return sorted(doc["_id"] for doc in collection.aggregate([
+        {"$sample": {"size": sample_size}},
+        {"$project": {"regions": {"$objectToArray": "$prices"}}},
+        {"$unwind": "$regions"},
+        {"$group": {"_id": "$regions.k"}},
+    ]))
+
+# Stages of the winning plan of a query, outermost first, e.g. ["FETCH", "IXSCAN"]
+def plan_stages(collection, query):
+    plan = collection.find(query).explain()["queryPlanner"]["winningPlan"]
+    plan = plan.get("queryPlan", plan)  # The slot-based engine wraps the plan
+    stages = []
+    while plan:
+        stages.append(plan["stage"])
+        plan = plan.get("inputStage")
+    return stages
+
+# Explains the queries of the API on a collection and logs the ones that scan it.
+# Returns {query name: stages}.
+def check_query_plans(collection, key_field):
+    queries = {"title": {"title": ""}, key_field: {key_field: ""}}
+    for region in price_regions(collection, 100)[:1]:
+        queries[f"prices.{region}"] = {f"prices.{region}": {"$ne": "Free or Not Available"}}
+    plans = {name: plan_stages(collection, query) for name, query in queries.items()}
+    for name, stages in plans.items():
+        if "COLLSCAN" in stages:
+            log_info(f"{collection.name} : queries on {name} scan the whole collection")
+    return plans
+
+# Finish a run. In incremental mode, games not seen since run_started are marked stale instead of deleted
+def update_mongo(db, collection_name, run_started=None, mode=None):
+    mode = mode or write_mode
+    if mode == "incremental":
+        ensure_indexes(db[collection_name], STORE_KEYS[collection_name])
+        if run_started is not None:
+            result = db[collection_name].update_many(
+                {"last_seen": {"$not": {"$gte": run_started}}, "stale": {"$ne": True}},
+                {"$set": {"stale": True, "stale_since": datetime.now(timezone.utc)}}
+            )
+            log_info(f"{collection_name} : {result.modified_count} games marked as stale")
+    else:
+        # Indexes are built on the full _tmp collection, so the swapped-in collection has them at once
+        drop_duplicate_keys(db[f"{collection_name}_tmp"], STORE_KEYS[collection_name])
+        ensure_indexes(db[f"{collection_name}_tmp"], STORE_KEYS[collection_name])
+        db[collection_name].drop()
+        db[f"{collection_name}_tmp"].rename(collection_name)
+    build_cheapest_view(db, collection_name)
+    bump_generation(db, collection_name)
+    if mode != "incremental":
+        # Only a report, the new data is already live
+        try:
+            check_query_plans(db[collection_name], STORE_KEYS[collection_name])
+        except (OperationFailure, KeyError) as e:
+            print(f"{collection_name} : Error checking the query plans: {e}")
+
+# Tells the API the games and the cheapest view of a collection changed
+def bump_generation(db, collection_name):
+    db[GENERATION_COLLECTION].update_one({"_id": collection_name}, {"$inc": {"generation": 1}}, upsert=True)
+
+# "<collection>_cheapest" holds, per game, every region price converted to the FX base
+# currency, the cheapest region and the spread. It is rebuilt after each run into a _tmp
+# collection and swapped in, so readers always see a complete view.
+def build_cheapest_view(db, collection_name, batch_size=mongo_batch_size):
+    try:
+        base, rates = load_fx_rates(fx_rates_path)
+    except (OSError, ValueError, KeyError) as e:
+        log_info(f"{collection_name} : cheapest view not built, no FX rates in {fx_rates_path}: {e}")
+        return
+    key_field = STORE_KEYS[collection_name]
+    view_name = f"{collection_name}_cheapest"
+    view_tmp = db[f"{view_name}_tmp"]
+    view_tmp.drop()
+
+    batch = []
+    games = db[collection_name].find(
+        {"stale": {"$ne": True}}, {"_id": 0, key_field: 1, "title": 1, "price_values": 1}
+    )
+    for game in games:
+        entry = cheapest_entry(game, key_field, base, rates)
+        if entry:
+            batch.append(entry)
+        if len(batch) >= batch_size:
+            view_tmp.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        view_tmp.insert_many(batch, ordered=False)
+    if view_tmp.estimated_document_count() == 0:
+        log_info(f"{view_name} : no priced games, view kept as it was")
+        return
+
+    view_tmp.create_index(key_field)
+    view_tmp.create_index("title")
+    view_tmp.create_index("min_price")
+    view_tmp.rename(view_name, dropTarget=True)
+    log_info(f"{view_name} : rebuilt with FX rates in {base}")
+
+def cheapest_entry(game, key_field, base, rates):
+    converted = {}
+    for region, price in (game.get("price_values") or {}).items():
+        if price["status"] in (PRICED, FREE):
+            amount = convert(price, base, rates)
+            if amount is not None:
+                converted[region] = amount
+    if not converted or game.get(key_field) is None:
+        return None
+    cheapest = min(converted, key=converted.get)
+    dearest = max(converted, key=converted.get)
+    low, high = converted[cheapest], converted[dearest]
+    return {
+        key_field: game[key_field],
+        "title": game.get("title"),
+        "currency": base,
+        "prices": converted,
+        "min_price": low,
+        "max_price": high,
+        "cheapest_region": cheapest,
+        "cheapest_price": game["price_values"][cheapest],
+        "dearest_region": dearest,
+        "spread": high - low,
+        "spread_pct": round((high - low) / high * 100, 1) if high else 0.0,
+    }
+
+# Bump last_seen of games that were skipped on purpose, so the stale marking keeps them
+def mark_seen(db, collection_name, keys, chunk_size=10000):
+    key_field = STORE_KEYS[collection_name]
+    now = datetime.now(timezone.utc)
+    for i in range(0, len(keys), chunk_size):
+        db[collection_name].update_many(
+            {key_field: {"$in": keys[i:i + chunk_size]}},
+            {"$set": {"last_seen": now, "stale": False}}
+        )
+
+# Games that only failed this run are still listed by the store, so the stale marking keeps
+# them. Permanent failures (a 404) are left to it. store_key maps a work queue key to the
+# store key when they differ.
+def mark_failures_seen(db, collection_name, failures, store_key=None, mode=None):
+    if (mode or write_mode) != "incremental":
+        return
+    keys = [store_key(key) if store_key else key for key, failure in failures.items() if not failure["permanent"]]
+    mark_seen(db, collection_name, keys)
+
+def content_hash(data):
+    content = {k: v for k, v in data.items() if k not in META_FIELDS}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+# One requests session per (proxy, headers) so TCP/TLS connections are reused across calls
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def load_proxies(path=None, share=None):
+    with open(path or proxy_file) as f:
+        proxies = [line.strip() for line in f if line.strip()]
+    share = share or proxy_slice
+    if share and proxies:
+        # Stores running side by side get disjoint parts of the list, at least one proxy each
+        start, end = (float(bound) for bound in share.split(":"))
+        first = min(int(start * len(proxies)), len(proxies) - 1)
+        proxies = proxies[first:max(int(end * len(proxies)), first + 1)]
+    return [proxy if "://" in proxy else f"http://{proxy}" for proxy in proxies]  # aiohttp needs the scheme
+
+# Tracks success rate, latency EWMA and 403/429 counts of every proxy and hands out healthy
+# ones. A proxy that keeps failing or gets a 403 is quarantined for a cooldown.
+# Run it in a WorkManager to share one view of the proxies between processes.
+class ProxyManager:
+    def __init__(self, proxies, max_failures=proxy_max_failures, quarantine_seconds=proxy_quarantine_seconds, alpha=0.2):
+        if not proxies:
+            raise ValueError("No proxies to manage")
+        self.proxies = list(proxies)
+        self.max_failures = max_failures
+        self.quarantine_seconds = quarantine_seconds
+        self.alpha = alpha  # Weight of the newest latency in the EWMA
+        self.lock = threading.Lock()
+        self.stats = {
+            proxy: {
+                "success": 0, "failure": 0, "failures_in_row": 0, "latency": None,
+                "forbidden": 0, "throttled": 0, "quarantines": 0, "quarantined_until": 0.0,
+            }
+            for proxy in self.proxies
+        }
+
+    def _score(self, proxy):
+        stats = self.stats[proxy]
+        success_rate = (stats["success"] + 1) / (stats["success"] + stats["failure"] + 2)
+        return success_rate / (stats["latency"] or 1.0)
+
+    # Picks the better of two random healthy proxies, which spreads the load while keeping
+    # work away from slow or failing ones
+    def get(self):
+        now = time.monotonic()
+        with self.lock:
+            healthy = [
+                proxy for proxy in random.sample(self.proxies, min(len(self.proxies), 8))
+                if self.stats[proxy]["quarantined_until"] <= now
+            ]
+            if not healthy:
+                healthy = [proxy for proxy in self.proxies if self.stats[proxy]["quarantined_until"] <= now]
+            if not healthy:
+                return min(self.proxies, key=lambda proxy: self.stats[proxy]["quarantined_until"])
+            return max(healthy[:2], key=self._score)
+
+    def report(self, proxy, ok, latency=None, status=None):
+        with self.lock:
+            stats = self.stats.get(proxy)
+            if stats is None:
+                return
+            if latency is not None:
+                stats["latency"] = latency if stats["latency"] is None else self.alpha * latency + (1 - self.alpha) * stats["latency"]
+            if status == 403:
+                stats["forbidden"] += 1
+            elif status == 429:
+                stats["throttled"] += 1
+            if ok:
+                stats["success"] += 1
+                stats["failures_in_row"] = 0
+                return
+            stats["failure"] += 1
+            stats["failures_in_row"] += 1
+            if status == 403 or stats["failures_in_row"] >= self.max_failures:
+                cooldown = self.quarantine_seconds * 2 ** min(stats["quarantines"], 5)
+                stats["quarantined_until"] = time.monotonic() + cooldown
+                stats["quarantines"] += 1
+                stats["failures_in_row"] = 0
+
+    def summary(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                "proxies": len(self.proxies),
+                "quarantined": sum(1 for stats in self.stats.values() if stats["quarantined_until"] > now),
+                "success": sum(stats["success"] for stats in self.stats.values()),
+                "failure": sum(stats["failure"] for stats in self.stats.values()),
+                "forbidden": sum(stats["forbidden"] for stats in self.stats.values()),
+                "throttled": sum(stats["throttled"] for stats in self.stats.values()),
+            }
+
+# A response the proxy itself is to blame for: blocked, throttled or broken upstream
+def proxy_ok(status):
+    return status < 500 and status not in (403, 407, 429)
+
+def log_proxy_stats(name, proxy_manager):
+    summary = proxy_manager.summary()
+    log_info(f"{name} proxies : {summary['proxies']} proxies, {summary['quarantined']} quarantined, "
+             f"{summary['success']} ok, {summary['failure']} failed, {summary['forbidden']} 403, {summary['throttled']} 429")
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+# Token bucket per (host, proxy). Every success raises the rate a little, a 429 cuts it and
+# blocks the bucket for Retry-After, so requests settle just under the throttle threshold.
+# Run it in a WorkManager to share the buckets between processes.
+class RateLimiter:
+    def __init__(self, initial=rate_initial, maximum=rate_max, minimum=rate_min,
+                 increase=rate_increase, decrease=rate_decrease):
+        self.initial = initial
+        self.maximum = maximum
+        self.minimum = minimum
+        self.increase = increase
+        self.decrease = decrease
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def _bucket(self, url, proxy):
+        key = (urlsplit(url).netloc or url, proxy)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = {"rate": self.initial, "tokens": 1.0, "updated": time.monotonic(), "blocked_until": 0.0}
+        return bucket
+
+    # Takes a token and returns the seconds to wait before sending. Tokens may go negative,
+    # which queues callers behind each other at the current rate.
+    def reserve(self, url, proxy=None):
+        now = time.monotonic()
+        with self.lock:
+            bucket = self._bucket(url, proxy)
+            burst = max(1.0, bucket["rate"])
+            bucket["tokens"] = min(burst, bucket["tokens"] + (now - bucket["updated"]) * bucket["rate"])
+            bucket["updated"] = now
+            bucket["tokens"] -= 1
+            wait = -bucket["tokens"] / bucket["rate"] if bucket["tokens"] < 0 else 0.0
+            return max(wait, bucket["blocked_until"] - now)
+
+    def acquire(self, url, proxy=None):
+        wait = self.reserve(url, proxy)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, url, proxy=None):
+        wait = self.reserve(url, proxy)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def report(self, url, proxy, status, retry_after=None):
+        with self.lock:
+            bucket = self._bucket(url, proxy)
+            if status == 429:
+                bucket["rate"] = max(self.minimum, bucket["rate"] * self.decrease)
+                pause = parse_retry_after(retry_after)
+                bucket["blocked_until"] = time.monotonic() + (pause if pause is not None else 1 / bucket["rate"])
+                bucket["tokens"] = 0.0
+            elif status < 400:
+                bucket["rate"] = min(self.maximum, bucket["rate"] + self.increase)
+
+    def rates(self):
+        with self.lock:
+            return {f"{host} {proxy or ''}".strip(): round(bucket["rate"], 2) for (host, proxy), bucket in self.buckets.items()}
+
+# Default limiter of the process, for paths without a shared one
+rate_limiter = RateLimiter()
+
+# Proxy manager, rate limiter and headers of a store. GETs go through a healthy proxy at the
+# allowed rate and report back. It pickles its manager proxies, so workers can get one.
+class ProxiedClient:
+    def __init__(self, proxy_manager, limiter=None, headers=None):
+        self.proxy_manager = proxy_manager
+        self.limiter = limiter or rate_limiter
+        self.headers = headers
+
+    def get(self, url, timeout=30, **kwargs):
+        proxy = self.proxy_manager.get()
+        time.sleep(self.limiter.reserve(url, proxy))  # Sleep here, not in the manager process
+        session = get_pooled_session(proxy, self.headers)
+        start = time.monotonic()
+        try:
+            response = session.get(url, timeout=timeout, **kwargs)
+        except requests.RequestException:
+            self.proxy_manager.report(proxy, False)
+            raise
+        self.proxy_manager.report(proxy, proxy_ok(response.status_code), time.monotonic() - start, response.status_code)
+        self.limiter.report(url, proxy, response.status_code, response.headers.get("Retry-After"))
+        response.raise_for_status()
+        return response
+
+# Request on a session without proxy, at the allowed rate for the host
+def rate_limited_request(session, method, url, limiter=None, **kwargs):
+    limiter = limiter or rate_limiter
+    time.sleep(limiter.reserve(url))
+    response = session.request(method, url, **kwargs)
+    limiter.report(url, None, response.status_code, response.headers.get("Retry-After"))
+    return response
+
+# Selenium shows no status codes, so page loads only take tokens and count as successes
+def rate_limited_browse(browser, url, limiter=None):
+    limiter = limiter or rate_limiter
+    time.sleep(limiter.reserve(url))
+    browser.get(url)
+    limiter.report(url, None, 200)
+
+# Exponential backoff with full jitter: a random delay up to base * 2^attempt, capped
+def backoff_delay(attempt, base=1.0, cap=30.0):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def get_pooled_session(proxy=None, headers=None):
+    key = (proxy, tuple(sorted(headers.items())) if headers else None)
+    now = time.monotonic()
+    with _sessions_lock:
+        # Close sessions idle longer than the keep-alive limit
+        for idle_key, (idle_session, last_used) in list(_sessions.items()):
+            if now - last_used > http_keepalive and idle_key != key:
+                idle_session.close()
+                del _sessions[idle_key]
+
+        if key in _sessions:
+            session = _sessions.pop(key)[0]
+        else:
+            if len(_sessions) >= http_max_sessions:
+                oldest_key = next(iter(_sessions))  # Least recently used
+                _sessions.pop(oldest_key)[0].close()
+            session = requests.Session()
+            if proxy:
+                session.proxies = {"http": proxy, "https": proxy}
+            if headers:
+                session.headers.update(headers)
+            # Retry on failure, GETs are revalidated against the HTTP cache
+            adapter = CachingAdapter(pool_connections=http_pool_connections, pool_maxsize=http_pool_maxsize, max_retries=3)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        _sessions[key] = (session, now)  # Re-insert to keep the dict in LRU order
+        return session
+
+# HTTP cache counters of all processes, take them before a run to log the run alone
+def http_cache_stats():
+    cache = get_http_cache()
+    return cache.stats() if cache else None
+
+def log_http_cache_stats(name, since=None):
+    stats = http_cache_stats()
+    if stats is None:
+        return
+    run = {key: stats[key] - (since or {}).get(key, 0) for key in STAT_NAMES}
+    log_info(f"{name} HTTP cache : {run['hits']} hits, {run['misses']} misses, {run['bytes_saved'] // 1024 // 1024} MB saved, "
+             f"{run['evictions']} evicted, {stats['entries']} entries, {stats['size_mb']} MB on disk")
+
+def close_pooled_sessions():
+    with _sessions_lock:
+        for session, _ in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+# Buffers documents for "<collection>_tmp" and writes them with unordered insert_many
+# when the batch is full or older than max_age. Use it as a context manager so the
+# last batch is flushed when the worker exits.
+# In incremental mode the batch is upserted into the live collection by the store key
+# instead, and games whose content hash did not change only get their last_seen bumped.
+class MongoWriter:
+    def __init__(self, db, collection_name, batch_size=mongo_batch_size, max_age=mongo_batch_age, mode=None):
+        self.collection_name = collection_name
+        self.mode = mode or write_mode
+        if self.mode == "incremental":
+            self.key_field = STORE_KEYS[collection_name]
+            self.collection = db[collection_name]
+            ensure_key_index(self.collection, self.key_field)
+        else:
+            self.collection = db[f"{collection_name}_tmp"]
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.buffer = []
+        self.buffer_started = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+        # Counters
+        self.docs_written = 0
+        self.docs_unchanged = 0
+        self.docs_failed = 0
+        self.flushes = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+        # Flush partial batches in the background so slow workers don't hold documents forever
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_on_age, daemon=True)
+        self.flusher.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # Every game gets price_values next to its display prices, parsed once here at ingest
+    def add(self, data):
+        if "prices" in data:
+            data["price_values"] = parse_prices(data["prices"])
+        with self.lock:
+            if not self.buffer:
+                self.buffer_started = time.monotonic()
+            self.buffer.append(data)
+            full = len(self.buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                docs, self.buffer = self.buffer, []
+                self.buffer_started = None
+            if not docs:
+                return
+
+            start = time.perf_counter()
+            unchanged = 0
+            try:
+                if self.mode == "incremental":
+                    written, unchanged = self._upsert(docs)
+                else:
+                    written = len(self.collection.insert_many(docs, ordered=False).inserted_ids)
+            except BulkWriteError as e:
+                written = e.details.get("nInserted", 0) + e.details.get("nUpserted", 0) + e.details.get("nModified", 0)
+                print(f"Mongo : {len(docs) - written} documents failed in {self.collection_name}: {e.details.get('writeErrors', [])[:1]}")
+            except Exception as e:
+                written = 0
+                print(f"Mongo : Error writing {len(docs)} documents to {self.collection_name}: {e}")
+            elapsed = time.perf_counter() - start
+
+            self.docs_written += written
+            self.docs_unchanged += unchanged
+            self.docs_failed += len(docs) - written - unchanged
+            self.flushes += 1
+            self.flush_seconds += elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+
+    # Returns (written, unchanged); documents superseded by a later one in the same batch count as unchanged
+    def _upsert(self, docs):
+        now = datetime.now(timezone.utc)
+        latest = {}
+        superseded = 0
+        for data in docs:
+            key = data.get(self.key_field)
+            if key is None:
+                print(f"Mongo : {self.collection_name} document without {self.key_field} skipped: {data.get('title')}")
+                continue
+            if key in latest:
+                superseded += 1
+            latest[key] = data  # The last document of a key in the batch wins
+
+        known = {
+            doc[self.key_field]: doc.get("content_hash")
+            for doc in self.collection.find({self.key_field: {"$in": list(latest)}}, {self.key_field: 1, "content_hash": 1})
+        }
+
+        operations = []
+        unchanged = 0
+        for key, data in latest.items():
+            data_hash = content_hash(data)
+            if known.get(key) == data_hash:
+                unchanged += 1
+                update = {"last_seen": now, "stale": False}
+            else:
+                update = {k: v for k, v in data.items() if k not in META_FIELDS}
+                update.update({"content_hash": data_hash, "last_seen": now, "stale": False})
+            operations.append(UpdateOne({self.key_field: key}, {"$set": update}, upsert=True))
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+        return len(operations) - unchanged, unchanged + superseded
+
+    def _flush_on_age(self):
+        while not self.closed.wait(max(self.max_age / 2, 0.1)):
+            started = self.buffer_started
+            if started is not None and time.monotonic() - started >= self.max_age:
+                self.flush()
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.flush()
+        atexit.unregister(self.close)
+        stats = self.stats()
+        log_info(f"{self.collection_name} writer : {stats['docs_written']} documents written, "
+                 f"{stats['docs_unchanged']} unchanged, {stats['docs_failed']} failed, {stats['flushes']} flushes, "
+                 f"avg flush {stats['avg_flush_ms']} ms, max flush {stats['max_flush_ms']} ms")
+
+    def stats(self):
+        return {
+            "docs_written": self.docs_written,
+            "docs_unchanged": self.docs_unchanged,
+            "docs_failed": self.docs_failed,
+            "flushes": self.flushes,
+            "avg_flush_ms": round(self.flush_seconds * 1000 / self.flushes, 1) if self.flushes else 0.0,
+            "max_flush_ms": round(self.max_flush_seconds * 1000, 1),
+        }
+
+# Shared work queue. Workers lease one item at a time and ack or fail it; failed items and
+# items whose lease expired (stuck or dead worker) go back to the queue, so idle workers
+# pick up the tail of the run. Run it in a WorkManager to share it between processes.
+# With max_pending set, put() blocks while that many items wait, so producers can't run
+# far ahead of the consumers.
+class WorkQueue:
+    def __init__(self, lease_seconds=work_lease_seconds, max_attempts=work_max_attempts, max_pending=None):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self.condition = threading.Condition()
+        self.pending = collections.deque()
+        self.items = {}  # Pending and leased items by key
+        self.leases = {}  # Lease deadline by key
+        self.attempts = collections.Counter()
+        self.keys = set()  # Every key ever queued, to drop duplicates
+        self.failed = {}  # Failure record by key, for items out of attempts or failed for good
+        self.done = 0
+        self.closed = False
+
+    # Returns False when the key was already queued
+    def put(self, key, item):
+        with self.condition:
+            if key in self.keys:
+                return False
+            while self.max_pending and len(self.pending) >= self.max_pending:
+                self.condition.wait()
+                if key in self.keys:
+                    return False
+            self.keys.add(key)
+            self.items[key] = item
+            self.pending.append(key)
+            self.condition.notify()
+            return True
+
+    def put_many(self, entries):
+        return sum(self.put(key, item) for key, item in entries)
+
+    # No more items will be put, lease() returns None once everything is done
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    # Returns (key, item), or None when the queue is closed and all items are finished
+    def lease(self, timeout=None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                for key, lease_deadline in list(self.leases.items()):
+                    if lease_deadline <= now:
+                        self._release(key, "lease expired")
+
+                if self.pending:
+                    key = self.pending.popleft()
+                    self.leases[key] = now + self.lease_seconds
+                    self.attempts[key] += 1
+                    self.condition.notify_all()  # Wake producers waiting for room
+                    return key, self.items[key]
+                if self.closed and not self.leases:
+                    return None
+
+                wait = min(self.leases.values(), default=now + 5) - now
+                if deadline is not None:
+                    if now >= deadline:
+                        return None
+                    wait = min(wait, deadline - now)
+                self.condition.wait(max(wait, 0.01))
+
+    def ack(self, key):
+        with self.condition:
+            if self.leases.pop(key, None) is None:
+                return  # Lease expired and the item is back in the queue or done elsewhere
+            self.items.pop(key, None)
+            self.done += 1
+            self.condition.notify_all()
+
+    # A permanent failure is not retried
+    def fail(self, key, reason="", permanent=False):
+        with self.condition:
+            if key in self.leases:
+                self._release(key, reason, permanent)
+                self.condition.notify_all()
+
+    def _release(self, key, reason, permanent=False):
+        del self.leases[key]
+        if not permanent and self.attempts[key] < self.max_attempts:
+            self.pending.append(key)
+        else:
+            self.failed[key] = failure_record(self.items.pop(key, None), reason, permanent, self.attempts[key])
+
+    def stats(self):
+        with self.condition:
+            return {
+                "pending": len(self.pending),
+                "leased": len(self.leases),
+                "done": self.done,
+                "failed": len(self.failed),
+            }
+
+    def failures(self):
+        with self.condition:
+            return dict(self.failed)
+
+class WorkManager(BaseManager):
+    pass
+
+WorkManager.register("WorkQueue", WorkQueue)
+WorkManager.register("ProxyManager", ProxyManager)
+WorkManager.register("RateLimiter", RateLimiter)
+
+def start_work_manager():
+    manager = WorkManager()
+    manager.start()
+    return manager
+
+# Send entries to the queue in chunks, so no single message holds the whole list
+def fill_work_queue(queue, entries, chunk_size=1000):
+    added = 0
+    for i in range(0, len(entries), chunk_size):
+        added += queue.put_many(entries[i:i + chunk_size])
+    return added
+
+def log_work_stats(name, queue):
+    stats = queue.stats()
+    log_info(f"{name} : {stats['done']} items done, {stats['failed']} failed")
+    for key, failure in list(queue.failures().items())[:20]:
+        log_info(f"{name} : gave up on {key}: {failure['reason']}")
+
+# Raised for items that will fail the same way on every attempt, like a missing page
+class PermanentError(Exception):
+    pass
+
+# Permanent errors go straight to the dead letters, everything else is retried up to
+# work_max_attempts times. Parse errors count as transient, a blocked page looks the same.
+def is_permanent(error):
+    if isinstance(error, PermanentError):
+        return True
+    response = getattr(error, "response", None)
+    return isinstance(error, requests.HTTPError) and response is not None and response.status_code in PERMANENT_STATUSES
+
+def failure_record(item, reason, permanent, attempts):
+    return {"item": item, "reason": reason, "permanent": permanent, "attempts": attempts}
+
+# Stores the failures of a run, {key: failure_record}. A key failing again is updated in place.
+def write_dead_letters(db, collection_name, failures, run_started=None):
+    if not failures:
+        return
+    now = datetime.now(timezone.utc)
+    operations = [
+        UpdateOne(
+            {"collection": collection_name, "key": key},
+            {"$set": {**failure, "failed_at": now, "run_started": run_started}, "$setOnInsert": {"first_failed_at": now}},
+            upsert=True
+        )
+        for key, failure in failures.items()
+    ]
+    collection = db[DEAD_LETTER_COLLECTION]
+    collection.create_index([("collection", 1), ("key", 1)], unique=True)
+    collection.bulk_write(operations, ordered=False)
+    log_info(f"{collection_name} : {len(operations)} items written to {DEAD_LETTER_COLLECTION}")
+
+# (key, item) entries of the dead letters of a collection, the permanent ones only if asked
+def load_dead_letters(db, collection_name, include_permanent=False):
+    query = {"collection": collection_name}
+    if not include_permanent:
+        query["permanent"] = {"$ne": True}
+    return [(doc["key"], doc["item"]) for doc in db[DEAD_LETTER_COLLECTION].find(query, {"key": 1, "item": 1})]
+
+def resolve_dead_letters(db, collection_name, keys):
+    if keys:
+        db[DEAD_LETTER_COLLECTION].delete_many({"collection": collection_name, "key": {"$in": list(keys)}})
 
 def get_selenium_browser(retries=3):
     options = Options()
@@ -152,6 +970,100 @@ def get_selenium_browser(retries=3):
     service = Service(chromedriver_path)
     return webdriver.Chrome(service=service, options=options)
 
+# Long-lived Selenium drivers of one worker process. A driver is health-checked before it
+# is lent out, reset between pages and recycled after max_pages or when its Chrome
+# processes grow past max_rss_mb.
+class BrowserPool:
+    def __init__(self, size=1, max_pages=browser_max_pages, max_rss_mb=browser_max_rss_mb):
+        self.size = size
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.idle = []
+        self.pages = {}  # Pages served by each live driver
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @contextmanager
+    def browser(self):
+        browser = self.acquire()
+        try:
+            yield browser
+        finally:
+            self.release(browser)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                browser = self.idle.pop() if self.idle else None
+            if browser is None:
+                browser = get_selenium_browser()
+                self.pages[browser] = 0
+                return browser
+            if self._is_healthy(browser):
+                return browser
+            self._quit(browser)
+
+    def release(self, browser):
+        self.pages[browser] = self.pages.get(browser, 0) + 1
+        if self.pages[browser] >= self.max_pages or self._rss_mb(browser) > self.max_rss_mb or not self._reset(browser):
+            self._quit(browser)
+            return
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(browser)
+                return
+        self._quit(browser)
+
+    def close(self):
+        with self.lock:
+            browsers, self.idle = self.idle, []
+        for browser in browsers:
+            self._quit(browser)
+
+    def _is_healthy(self, browser):
+        try:
+            return browser.execute_script("return 1") == 1
+        except WebDriverException:
+            return False
+
+    # Close extra tabs and drop cookies and storage, so the next page starts clean
+    def _reset(self, browser):
+        try:
+            handles = browser.window_handles
+            for handle in handles[1:]:
+                browser.switch_to.window(handle)
+                browser.close()
+            browser.switch_to.window(handles[0])
+            browser.delete_all_cookies()
+            try:
+                browser.execute_script("window.localStorage.clear(); window.sessionStorage.clear();")
+            except WebDriverException:
+                pass  # Pages without storage access
+            browser.get("about:blank")
+            return True
+        except WebDriverException:
+            return False
+
+    def _rss_mb(self, browser):
+        try:
+            driver_process = psutil.Process(browser.service.process.pid)
+            processes = [driver_process] + driver_process.children(recursive=True)
+            return sum(process.memory_info().rss for process in processes) / (1024 * 1024)
+        except (psutil.Error, AttributeError):
+            return 0
+
+    def _quit(self, browser):
+        self.pages.pop(browser, None)
+        try:
+            browser.quit()
+        except Exception as e:
+            print(f"Error closing browser: {e}")
+
 def click_loadmore_btn(browser, btn_dom):
     count = 0
     while True: